@@ -0,0 +1,56 @@
+"""
+Compare the chunked clustering engine against brute-force DBSCAN.
+
+    python benchmark_clustering.py --frames_dir out/<title>/frames
+    python benchmark_clustering.py --synthetic 30000
+
+Prints the wall time of both engines, the adjusted Rand index between
+their labelings and the share of faces that get the same char_<N> label.
+"""
+import time
+import numpy as np
+from argparse import ArgumentParser
+from sklearn.metrics import adjusted_rand_score
+
+from utils.detect_and_cluster import cluster_labels, FaceEngine, list_frames
+
+
+def synthetic_embeddings(n, num_chars=40, dim=512, spread=0.35, seed=0):
+    """Unit vectors scattered around num_chars random identities."""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(num_chars, dim))
+    centers /= np.linalg.norm(centers, axis=1, keepdims=True)
+    ids = rng.integers(0, num_chars, size=n)
+    x = centers[ids] + rng.normal(scale=spread / np.sqrt(dim), size=(n, dim))
+    return (x / np.linalg.norm(x, axis=1, keepdims=True)).astype(np.float32)
+
+
+def run(embeddings, eps, min_samples):
+    results = {}
+    for engine in ("dbscan", "chunked"):
+        start = time.time()
+        labels = cluster_labels(embeddings, eps=eps, min_samples=min_samples, engine=engine)
+        results[engine] = (labels, time.time() - start)
+        print(f"   🔹 {engine}: {len(set(labels))} clusters in {results[engine][1]:.2f}s")
+
+    base, chunked = results["dbscan"][0], results["chunked"][0]
+    print(f"   🔹 Adjusted Rand index: {adjusted_rand_score(base, chunked):.4f}")
+    print(f"   🔹 Identical labels: {np.mean(base == chunked) * 100:.2f}%")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument('--frames_dir', type=str)
+    parser.add_argument('--synthetic', type=int, default=0, help="number of synthetic faces")
+    parser.add_argument('--eps', type=float, default=0.55)
+    parser.add_argument('--min_samples', type=int, default=4)
+    args = parser.parse_args()
+
+    if args.frames_dir:
+        faces = FaceEngine().extract(list_frames(args.frames_dir))
+        embeddings = np.stack([f["embedding"] for f in faces])
+    else:
+        embeddings = synthetic_embeddings(args.synthetic or 10000)
+
+    print(f"\n👥 Clustering {len(embeddings)} faces")
+    run(embeddings, args.eps, args.min_samples)
@@ -0,0 +1,70 @@
+"""
+Compare fast or parallel shot detection against the full-resolution run on sample clips.
+
+    python benchmark_shots.py clip1.mp4 clip2.mp4 --downscale 4 --frame_skip 1
+    python benchmark_shots.py movie.mp4 --mode parallel --workers 32
+
+For every clip it prints both wall times and how many full-run cuts the
+candidate run reproduces within --tolerance seconds (recall), how many of
+its cuts are real (precision) and the mean offset of matched cuts.
+"""
+import time
+from argparse import ArgumentParser
+
+from config import SCENE_THRESHOLD
+from utils.detect_shots import detect_shots_full, detect_shots_fast, detect_shots_parallel
+
+
+def cut_seconds(scene_list):
+    # every scene start except the first is a cut
+    return [start.get_seconds() for start, _ in scene_list[1:]]
+
+
+def match_cuts(reference, candidate, tolerance):
+    """Greedy one-to-one matching of cut timestamps within tolerance seconds."""
+    unmatched = list(candidate)
+    offsets = []
+    for ref in reference:
+        best = min(unmatched, key=lambda c: abs(c - ref), default=None)
+        if best is not None and abs(best - ref) <= tolerance:
+            offsets.append(abs(best - ref))
+            unmatched.remove(best)
+    return offsets
+
+
+def benchmark(video_path, threshold, downscale, frame_skip, tolerance, mode="fast", workers=8):
+    start = time.time()
+    full = cut_seconds(detect_shots_full(video_path, threshold=threshold))
+    full_time = time.time() - start
+
+    start = time.time()
+    if mode == "parallel":
+        fast = cut_seconds(detect_shots_parallel(video_path, threshold=threshold, workers=workers))
+    else:
+        fast = cut_seconds(detect_shots_fast(video_path, threshold=threshold, downscale=downscale, frame_skip=frame_skip))
+    fast_time = time.time() - start
+
+    offsets = match_cuts(full, fast, tolerance)
+    recall = len(offsets) / len(full) if full else 1.0
+    precision = len(offsets) / len(fast) if fast else 1.0
+    mean_offset = sum(offsets) / len(offsets) if offsets else 0.0
+
+    print(f"\n🎬 {video_path}")
+    print(f"   🔹 Full: {len(full)} cuts in {full_time:.2f}s")
+    print(f"   🔹 {mode.capitalize()}: {len(fast)} cuts in {fast_time:.2f}s ({full_time / max(fast_time, 1e-6):.1f}x)")
+    print(f"   🔹 Recall: {recall:.3f} | Precision: {precision:.3f} | Mean offset: {mean_offset:.3f}s")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument('videos', nargs='+')
+    parser.add_argument('--threshold', type=float, default=SCENE_THRESHOLD)
+    parser.add_argument('--downscale', type=int, default=4)
+    parser.add_argument('--frame_skip', type=int, default=1)
+    parser.add_argument('--tolerance', type=float, default=0.5, help="seconds between matching cuts")
+    parser.add_argument('--mode', choices=['fast', 'parallel'], default='fast')
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args()
+
+    for video in args.videos:
+        benchmark(video, args.threshold, args.downscale, args.frame_skip, args.tolerance, mode=args.mode, workers=args.workers)
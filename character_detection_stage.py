@@ -1,44 +1,74 @@
 import os
 import time
 
-from utils.detect_and_cluster import process_video_faces
-from utils.job_queue import update_job_stage, fetch_next_job, mark_job_failed
-from config import SLEEP_DURATION, DEBUG_MODE
+from utils.detect_and_cluster import process_video_faces, FaceEngine, FacePool
+from utils.job_queue import update_job_stage, fetch_next_jobs, mark_job_failed, wait_for_job, start_job, keep_lease_alive, retry_job, stop_on_signals, release_jobs, StopRequested, batch_size
+from config import SLEEP_DURATION, DEBUG_MODE, FACE_BATCH_SIZE, FACE_PREFETCH, FACE_WORKERS, FACE_INTRA_OP_THREADS, FACE_CLUSTER_ENGINE, FACE_FRAME_CACHE_MB, FACE_CROP_FORMAT, FACE_CROP_WRITERS, ANNOTATE_FRAMES
 from utils.aud_db_utils import get_pg_conn
 
-conn = get_pg_conn()
-debug = DEBUG_MODE
-sleep_time = SLEEP_DURATION
-status = "pending"
-
-while True:
-    job = fetch_next_job(conn, 'character_detection', status=status) 
-    
-    if job:
-        # try:
-        start = time.time()
-        
-        local_path = job.get('local_path', None)
-        if local_path:
-            
-            dir_path = os.path.dirname(local_path)
-            video_name = os.path.splitext(os.path.basename(local_path))[0]
-            combined = os.path.join(dir_path, video_name)
-
-            print("\nlocal_path : ", local_path, combined, "\n")
-            process_video_faces(combined)
-            character_detection_time = time.time() - start
-            update_job_stage(conn, job['id'], 'inference', new_status='pending', addons=[f"local_path = '{local_path}'", f"character_detection_time = {character_detection_time:0.2f}"])
-        else:
-            mark_job_failed(conn, job['id'])
-            raise ValueError("No local_path found in job")
-       
-        # except Exception as e:
-        #     print("Download failed for:", e)
-
-        if debug:
-            print("Exiting due to debug mode")
-            break
+# process pools re-import this module in their workers, so only run the loop as a script
+if __name__ == "__main__":
+    conn = get_pg_conn()
+    debug = DEBUG_MODE
+    sleep_time = SLEEP_DURATION
+    status = "pending"
+
+    # models are loaded once per worker, not once per title
+    if FACE_WORKERS > 1:
+        face_engine = FacePool(FACE_WORKERS, intra_op_threads=FACE_INTRA_OP_THREADS, batch_size=FACE_BATCH_SIZE, prefetch=FACE_PREFETCH)
     else:
-        print(f"character_detection_stage : sleeping for {sleep_time} seconds")
-        time.sleep(sleep_time)
+        face_engine = FaceEngine(batch_size=FACE_BATCH_SIZE, prefetch=FACE_PREFETCH)
+
+    stop_on_signals()
+    held, current = set(), None
+    try:
+        while True:
+            jobs = fetch_next_jobs(conn, 'character_detection', batch_size('character_detection'), status=status) 
+
+            if jobs:
+                # heartbeat the whole batch, so queued jobs keep their lease while earlier ones run
+                held = {job['id'] for job in jobs}
+                with keep_lease_alive(held):
+                    for job in jobs:
+                        if not start_job(conn, job):
+                            # the lease on a queued job expired and another worker reclaimed it
+                            print("Lease lost, skipping job:", job['id'])
+                            held.discard(job['id'])
+                            continue
+                        current = job['id']
+                        try:
+                            start = time.time()
+
+                            local_path = job.get('local_path', None)
+                            if local_path:
+
+                                dir_path = os.path.dirname(local_path)
+                                video_name = os.path.splitext(os.path.basename(local_path))[0]
+                                combined = os.path.join(dir_path, video_name)
+
+                                print("\nlocal_path : ", local_path, combined, "\n")
+                                process_video_faces(combined, face_engine, cluster_engine=FACE_CLUSTER_ENGINE, frame_cache_mb=FACE_FRAME_CACHE_MB,
+                                                    crop_format=FACE_CROP_FORMAT, crop_writers=FACE_CROP_WRITERS,
+                                                    annotate=ANNOTATE_FRAMES)
+                                character_detection_time = time.time() - start
+                                update_job_stage(conn, job['id'], 'inference', new_status='pending', addons=[f"local_path = '{local_path}'", f"character_detection_time = {character_detection_time:0.2f}"])
+                            else:
+                                # the rest of the claimed batch is still in_progress, so keep going instead of raising
+                                print("No local_path found in job:", job['id'])
+                                mark_job_failed(conn, job['id'], error="No local_path found in job")
+                        except Exception as e:
+                            print("Character detection failed for:", job['id'], e)
+                            retry_job(conn, job, e)
+                        # not a finally: a job interrupted by StopRequested stays held so it is released
+                        held.discard(job['id'])
+                        current = None
+
+                if debug:
+                    print("Exiting due to debug mode")
+                    break
+            else:
+                print(f"character_detection_stage : waiting up to {sleep_time} seconds for new jobs")
+                wait_for_job(conn, 'character_detection', timeout=sleep_time)
+    except StopRequested as e:
+        released = release_jobs(conn, held, started=current)
+        print(f"character_detection_stage : stopped by {e}, returned {released} unfinished jobs to the queue")
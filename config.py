@@ -1,3 +1,4 @@
+import os
 
 PROJECT="js-titan-dslabs"
 LOCATION="us-central1"
@@ -7,6 +8,19 @@ EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
 LOCAL_VIDEO_DIR = "/Users/amana1/working_dir/videos"
 LOCAL_PROCESSING_DIR = "/Users/amana1/working_dir/Meta_Extraction/out"
 MAX_WORKERS = 10
+INFERENCE_ENGINE = "async"  # "async": one scheduler for every (segment, prompt) call, "threads": a pool per prompt
+
+# client-side Vertex limits, shared by every inference / shot description process through RATE_LIMIT_TABLE
+GEMINI_RPM = 300
+GEMINI_TPM = 1_000_000
+GEMINI_MAX_CONCURRENCY = MAX_WORKERS  # AIMD ceiling per process, halved on every 429
+GEMINI_MAX_RETRIES = 5
+GEMINI_BACKOFF_BASE = 2  # seconds, full jitter
+GEMINI_BACKOFF_MAX = 60
+GEMINI_SHARED_LIMITS = True  # False keeps the buckets in-process
+GEMINI_CACHE = True  # reuse responses for byte-identical requests across runs
+GEMINI_CACHE_PATH = os.path.join(LOCAL_PROCESSING_DIR, "gemini_cache.sqlite")
+GEMINI_CACHE_MAX_MB = 2048
 
 PROMPT_TEMPLATES_DIR = "/Users/amana1/working_dir/Meta_Extraction/prompts"
 DEBUG_MODE = True
@@ -14,11 +28,85 @@ DEBUG_MODE = True
 #character detection params
 RESIZE_WIDTH = 640
 SCENE_THRESHOLD = 30.0
+SHOT_DETECTION_MODE = "full"  # "full", "fast" (downscaled, frame-skipping) or "parallel" (time windows)
+SHOT_DOWNSCALE = 4
+SHOT_FRAME_SKIP = 1
+SHOT_DETECTION_WORKERS = 8
+SHOT_WINDOW_OVERLAP = 2.0  # seconds each parallel window re-scans before its start
+SHOT_CLIP_WORKERS = 4  # concurrent ffmpeg processes cutting shots/*.mp4
+WRITE_SHOT_CLIPS = True  # False keeps only shots.json; clips are cut on demand with get_shot_clip
 FACE_SIM_THRESHOLD = 0.45          
 FACE_PAD = 0.2 
+FACE_BATCH_SIZE = 32  # aligned faces per recognition batch
+FACE_PREFETCH = 4  # frame decode threads
+FACE_WORKERS = 1  # >1 shards frames over a pool of processes, each with its own FaceEngine
+FACE_INTRA_OP_THREADS = 2  # ONNX threads per face worker process
+FACE_CLUSTER_ENGINE = "chunked"  # "dbscan" (brute-force cosine) or "chunked" (same labels, bounded memory)
+FACE_FRAME_CACHE_MB = 2048  # decoded frames kept in memory across the face passes of a title
+FACE_CROP_FORMAT = "jpg"  # "jpg" (one file per crop), "sheet" (contact sheets per cluster) or "zip" (one archive per cluster)
+FACE_CROP_WRITERS = 8  # threads encoding and writing face crops
+ANNOTATE_FRAMES = True  # False: skip annotated_frames/, inference sends frames/ with the faces.json boxes in the prompt
 
 CHUNK_DURATION = 5  # in seconds
+FRAME_SAMPLER_WORKERS = 1  # >1 decodes time ranges of a title in parallel processes
+SHARED_DECODE = True  # one decode pass for frames, audio chunks and shot detection in download_stage
 SLEEP_DURATION = 60  # in seconds
+# jobs claimed per round trip by a stage worker; the whole batch stays leased
+# while it runs, so stages with hour-long titles claim one at a time
+JOB_BATCH_SIZE = {
+    "default": 1,
+    "download": 2,
+    "character_detection": 1,
+    "inference": 1,
+    "shot_description": 2,
+}
+LEASE_DURATION = 600  # seconds a claimed job stays owned without a heartbeat
+HEARTBEAT_INTERVAL = 60  # in seconds
+
+# attempts per stage before a job is parked at 'failed'
+MAX_ATTEMPTS = {
+    "default": 3,
+    "download": 3,
+    "character_detection": 2,
+    "inference": 4,
+    "shot_description": 4,
+}
+RETRY_BASE_DELAY = 60  # seconds, doubled on every further attempt
+RETRY_MAX_DELAY = 3600  # in seconds
+
+# run_pipeline.py supervisor
+STAGE_SCRIPTS = {
+    "download": "download_stage.py",
+    "character_detection": "character_detection_stage.py",
+    "inference": "inference_stage.py",
+    "shot_description": "shot_description_stage.py",
+}
+STAGE_WORKERS = {
+    "download": 3,
+    "character_detection": 3,
+    "inference": 3,
+    "shot_description": 3,
+}
+# autoscaling: worker count per stage is kept within (min, max) and the
+# summed STAGE_CPU_COST of all workers within CPU_BUDGET
+AUTOSCALE = True
+AUTOSCALE_INTERVAL = 30  # in seconds
+STAGE_WORKER_LIMITS = {
+    "download": (1, 4),
+    "character_detection": (1, 8),
+    "inference": (1, 6),
+    "shot_description": (1, 4),
+}
+STAGE_CPU_COST = {
+    "download": 1.0,
+    "character_detection": 4.0,
+    "inference": 0.5,
+    "shot_description": 0.5,
+}
+CPU_BUDGET = os.cpu_count() or 4
+RESTART_DELAY = 5  # seconds before restarting a crashed worker, doubled per consecutive crash
+MAX_RESTART_DELAY = 300  # in seconds
+SHUTDOWN_TIMEOUT = 30  # seconds to wait for workers after SIGTERM before killing them
 
 
 ###Database Configs###
@@ -30,6 +118,7 @@ HOST="localhost"
 PORT="5432"
 
 PIPELINE_TABLE = "pipeline_jobs"
+RATE_LIMIT_TABLE = "gemini_rate_limits"
 
 VIDEO_TABLE = "video_meta"
 AUDIO_TABLE = "audio_meta"
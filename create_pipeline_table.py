@@ -1,5 +1,5 @@
 from utils.aud_db_utils import get_pg_conn
-from config import PIPELINE_TABLE
+from config import PIPELINE_TABLE, RATE_LIMIT_TABLE
 
 conn = get_pg_conn()
 table = PIPELINE_TABLE
@@ -28,8 +28,29 @@ CREATE TABLE IF NOT EXISTS {table} (
 
     infer_logs JSONB,
     status TEXT CHECK (status IN ('pending', 'in_progress', 'done', 'failed')) DEFAULT 'pending',
+    lease_owner TEXT DEFAULT NULL,
+    lease_expires_at TIMESTAMP DEFAULT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT DEFAULT NULL,
+    not_before TIMESTAMP DEFAULT NULL,
     updated_at TIMESTAMP DEFAULT NOW()
 );
+
+ALTER TABLE {table} ADD COLUMN IF NOT EXISTS lease_owner TEXT DEFAULT NULL;
+ALTER TABLE {table} ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMP DEFAULT NULL;
+ALTER TABLE {table} ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE {table} ADD COLUMN IF NOT EXISTS last_error TEXT DEFAULT NULL;
+ALTER TABLE {table} ADD COLUMN IF NOT EXISTS not_before TIMESTAMP DEFAULT NULL;
+
+-- rows left in_progress before leases existed have no owner to wait for
+UPDATE {table} SET lease_expires_at = NOW()
+WHERE status = 'in_progress' AND lease_expires_at IS NULL;
+
+CREATE TABLE IF NOT EXISTS {RATE_LIMIT_TABLE} (
+    name TEXT PRIMARY KEY,
+    tokens DOUBLE PRECISION NOT NULL,
+    updated_at TIMESTAMPTZ NOT NULL
+);
 """
 cursor = conn.cursor()
 cursor.execute(query)
@@ -48,11 +48,13 @@ feature_columns = [
 debug = True
 num = 10
 i = 0
-status = "in_progress"
+status = "pending"
 
 while True:
     job = fetch_next_job(conn, 'db_insertion', status=status)
     # print(job)
+    if job and not start_job(conn, job):
+        continue
     if job:
         i += 1
         try:
@@ -2,58 +2,87 @@ import os
 import time
 from utils.download import download_s3_file, download_local_file
 
-from utils.job_queue import update_job_stage, fetch_next_job, mark_job_failed
-from config import LOCAL_VIDEO_DIR, SLEEP_DURATION, DEBUG_MODE, SCENE_THRESHOLD, CHUNK_DURATION
+from utils.job_queue import update_job_stage, fetch_next_jobs, mark_job_failed, wait_for_job, start_job, keep_lease_alive, retry_job, stop_on_signals, release_jobs, StopRequested, batch_size
+from config import LOCAL_VIDEO_DIR, SLEEP_DURATION, DEBUG_MODE, SCENE_THRESHOLD, CHUNK_DURATION, FRAME_SAMPLER_WORKERS, SHARED_DECODE
+from config import SHOT_DETECTION_MODE, SHOT_DOWNSCALE, SHOT_FRAME_SKIP, SHOT_DETECTION_WORKERS, SHOT_WINDOW_OVERLAP, SHOT_CLIP_WORKERS, WRITE_SHOT_CLIPS
 from utils.aud_db_utils import get_pg_conn
 from utils.video_utils import split_video
 from utils.detect_shots import detect_and_split_shots
-conn = get_pg_conn()
-debug = DEBUG_MODE
-sleep_time = SLEEP_DURATION
-
-status = "pending"
-local_base_dir = LOCAL_VIDEO_DIR
-
-i = 0
-while True:
-    job = fetch_next_job(conn, 'download', status=status) # instead of fetching one job at a time, we can fetch multiple jobs and process in parallel
-    
-    if job:
-        try:
-            start = time.time()
-            s3_key = job['s3_key']
-            new_filename = job['filename'].replace('/', '\/')
-            config = job['config']
-            print("config : ", new_filename, "\n")
-
-            local_dir = os.path.join(config['download_dir'], config['network'], config['media_type'], config['language'], config['channel'] if config['channel'] is not None else '')
- 
-            print(s3_key, local_dir, new_filename, config['download_dir'])
-            local_path = download_local_file(local_base_dir, s3_key, local_dir, new_filename, config['download_dir'])
-            download_time = time.time() - start
-
-            if local_path:
-                ### these two functions can be run parallelly
-                start = time.time()
-                split_video(local_path, local_dir, split_duration=CHUNK_DURATION)
-                spliting_time = time.time() - start
-                detect_and_split_shots(video_path=local_path, threshold=SCENE_THRESHOLD)
-                shot_detection_time = time.time() - spliting_time
+from utils.media_pass import analyze_media
+# process pools re-import this module in their workers, so only run the loop as a script
+if __name__ == "__main__":
+    conn = get_pg_conn()
+    debug = DEBUG_MODE
+    sleep_time = SLEEP_DURATION
+
+    status = "pending"
+    local_base_dir = LOCAL_VIDEO_DIR
+
+    i = 0
+    stop_on_signals()
+    held, current = set(), None
+    try:
+        while True:
+            jobs = fetch_next_jobs(conn, 'download', batch_size('download'), status=status)
+
+            if jobs:
+                # heartbeat the whole batch, so queued jobs keep their lease while earlier ones run
+                held = {job['id'] for job in jobs}
+                with keep_lease_alive(held):
+                    for job in jobs:
+                        if not start_job(conn, job):
+                            # the lease on a queued job expired and another worker reclaimed it
+                            print("Lease lost, skipping job:", job['id'])
+                            held.discard(job['id'])
+                            continue
+                        current = job['id']
+                        try:
+                            start = time.time()
+                            s3_key = job['s3_key']
+                            new_filename = job['filename'].replace('/', '\/')
+                            config = job['config']
+                            print("config : ", new_filename, "\n")
+
+                            local_dir = os.path.join(config['download_dir'], config['network'], config['media_type'], config['language'], config['channel'] if config['channel'] is not None else '')
+
+                            print(s3_key, local_dir, new_filename, config['download_dir'])
+                            local_path = download_local_file(local_base_dir, s3_key, local_dir, new_filename, config['download_dir'])
+                            download_time = time.time() - start
+
+                            if local_path:
+                                start = time.time()
+                                if SHARED_DECODE and SHOT_DETECTION_MODE != "parallel":
+                                    fast = SHOT_DETECTION_MODE == "fast"
+                                    analyze_media(local_path, local_dir, split_duration=CHUNK_DURATION, threshold=SCENE_THRESHOLD,
+                                                  downscale=SHOT_DOWNSCALE if fast else None, frame_skip=SHOT_FRAME_SKIP if fast else 0, clip_workers=SHOT_CLIP_WORKERS, write_clips=WRITE_SHOT_CLIPS)
+                                    shot_detection_time = time.time() - start
+                                else:
+                                    split_video(local_path, local_dir, split_duration=CHUNK_DURATION, workers=FRAME_SAMPLER_WORKERS)
+                                    spliting_time = time.time() - start
+                                    detect_and_split_shots(video_path=local_path, threshold=SCENE_THRESHOLD, mode=SHOT_DETECTION_MODE, downscale=SHOT_DOWNSCALE, frame_skip=SHOT_FRAME_SKIP,
+                                                           workers=SHOT_DETECTION_WORKERS, overlap_seconds=SHOT_WINDOW_OVERLAP, clip_workers=SHOT_CLIP_WORKERS, write_clips=WRITE_SHOT_CLIPS)
+                                    shot_detection_time = time.time() - spliting_time
+                            else:
+                                print("\nlocal_path : ", local_path,"\n")
+                                raise ValueError("Download returned no local_path")
+
+                            if local_path:
+                                print("Downloaded to:", local_path)
+                                update_job_stage(conn, job['id'], 'character_detection', new_status='pending', addons=[f"local_path = '{local_path}'", f"download_time = {download_time:0.2f}", f"shot_detection_time = {shot_detection_time:0.2f}"])
+
+                        except Exception as e:
+                            print("Download failed for:", s3_key, e)
+                            retry_job(conn, job, e)
+                        # not a finally: a job interrupted by StopRequested stays held so it is released
+                        held.discard(job['id'])
+                        current = None
+
+                if debug:
+                    print("Exiting due to debug mode")
+                    break
             else:
-                print("\nlocal_path : ", local_path,"\n")
-                raise ValueError("Download returned no local_path")
-
-            if local_path:
-                print("Downloaded to:", local_path)
-                update_job_stage(conn, job['id'], 'character_detection', new_status='pending', addons=[f"local_path = '{local_path}'", f"download_time = {download_time:0.2f}", f"shot_detection_time = {shot_detection_time:0.2f}"])
-
-        except Exception as e:
-            print("Download failed for:", s3_key, e)
-            mark_job_failed(conn, job['id'])
-
-        if debug:
-            print("Exiting due to debug mode")
-            break
-    else:
-        print(f"download_stage : sleeping for {sleep_time} seconds")
-        time.sleep(sleep_time)
+                print(f"download_stage : waiting up to {sleep_time} seconds for new jobs")
+                wait_for_job(conn, 'download', timeout=sleep_time)
+    except StopRequested as e:
+        released = release_jobs(conn, held, started=current)
+        print(f"download_stage : stopped by {e}, returned {released} unfinished jobs to the queue")
@@ -1,6 +1,7 @@
 from glob import glob
 from utils.aud_db_utils import get_pg_conn
 from psycopg2.extras import execute_values
+from utils.job_queue import notify_stage, reclaim_expired_jobs
 
 import time
 import pandas as pd
@@ -21,6 +22,10 @@ table = PIPELINE_TABLE
 
 
 while True:
+    reclaimed = reclaim_expired_jobs(conn)
+    if reclaimed:
+        print("Re-queued jobs with expired leases:", reclaimed)
+
     cursor = conn.cursor()
     files = glob('jobs/*.xlsx')
     files.sort()
@@ -38,7 +43,9 @@ while True:
                                      (stage, priority, s3_key, filename, config) VALUES %s \
                                      ON CONFLICT (s3_key) DO UPDATE SET \
                                         priority = EXCLUDED.priority", data)
-                                        
+
+            for stage in sorted({row[0] for row in data}):
+                notify_stage(cursor, stage)
             conn.commit()
             old_job = new_job
 
@@ -9,7 +9,8 @@ from config import (
     SLEEP_DURATION, CHUNK_DURATION, 
     DEBUG_MODE, PROMPT_TEMPLATES_DIR, 
     PROJECT, LOCATION, 
-    MODEL, MAX_WORKERS, TEMPERATURE
+    MODEL, MAX_WORKERS, TEMPERATURE,
+    ANNOTATE_FRAMES, INFERENCE_ENGINE
 )
 
 conn = get_pg_conn()
@@ -25,52 +26,77 @@ args = {
     'chunk_size': CHUNK_DURATION,
     'max_workers': MAX_WORKERS,
     'prompt_dir': PROMPT_TEMPLATES_DIR,
+    'annotated_frames': ANNOTATE_FRAMES,
+    'engine': INFERENCE_ENGINE,
 }
 
 status = "pending"
-while True:
-    job = fetch_next_job(conn, 'inference', status=status) # if fetched then status="in_progress"
+stop_on_signals()
+held, current = set(), None
+try:
+    while True:
+        jobs = fetch_next_jobs(conn, 'inference', batch_size('inference'), status=status) # fetched jobs are "in_progress"
 
-    if job:
-        try:
-            start = time.time()
-            local_path = job['local_path']
-            dir_path = os.path.dirname(local_path)
-            video_name = os.path.splitext(os.path.basename(local_path))[0]
-            combined = os.path.join(dir_path, video_name)
+        if jobs:
+            # heartbeat the whole batch, so queued jobs keep their lease while earlier ones run
+            held = {job['id'] for job in jobs}
+            with keep_lease_alive(held):
+                for job in jobs:
+                    if not start_job(conn, job):
+                        # the lease on a queued job expired and another worker reclaimed it
+                        print("Lease lost, skipping job:", job['id'])
+                        held.discard(job['id'])
+                        continue
+                    current = job['id']
+                    try:
+                        start = time.time()
+                        local_path = job['local_path']
+                        dir_path = os.path.dirname(local_path)
+                        video_name = os.path.splitext(os.path.basename(local_path))[0]
+                        combined = os.path.join(dir_path, video_name)
 
-            if os.path.exists(os.path.join(combined, "prompt1")):
-                print("Skipping ...")
-                update_job_stage(conn, job['id'], 'shot_description', new_status="failed")
-                continue
-            
-            args['output_dir'] = combined
-            print("Inference args : ", args)
-            
-            get_meta_data(args)
-            merge_prompt1_prompt2(combined)
-            merge_prompt3_prompt4(combined)
-            inference_time = time.time() - start
-            print("Inference time:", inference_time)
+                        # get_meta_data resumes from the prompt<N>/ chunk files a previous run left behind
+                        args['output_dir'] = combined
+                        print("Inference args : ", args)
+                
+                        missing = get_meta_data(args)
+                        gaps = f"{missing} (prompt, chunk) requests still have no result" if missing else None
+                        if missing and job['attempts'] < max_attempts('inference'):
+                            # the finished chunks are checkpointed, so the retry only redoes these
+                            raise RuntimeError(gaps)
+                        if missing:
+                            # a segment Gemini never answers must not cost the whole title
+                            print(f"⚠️ Last attempt for job {job['id']}, promoting partial results: {gaps}")
+                        merge_prompt1_prompt2(combined)
+                        merge_prompt3_prompt4(combined)
+                        inference_time = time.time() - start
+                        print("Inference time:", inference_time)
 
-            update_job_stage(
-                conn,
-                job['id'],
-                'shot_description',
-                new_status='pending',
-                addons=[
-                    f"inference_time = {inference_time:0.2f}"
-                ]
-            )
+                        update_job_stage(
+                            conn,
+                            job['id'],
+                            'shot_description',
+                            new_status='pending',
+                            addons=[
+                                f"inference_time = {inference_time:0.2f}"
+                            ],
+                            error=gaps
+                        )
 
-        except Exception as e:
-            print(f"Job failed: {str(e)}")
-            mark_job_failed(conn, job['id'])
+                    except Exception as e:
+                        print(f"Job failed: {str(e)}")
+                        retry_job(conn, job, e)
+                    # not a finally: a job interrupted by StopRequested stays held so it is released
+                    held.discard(job['id'])
+                    current = None
 
-        if debug:
-            print("Exiting due to debug mode")
-            break
+            if debug:
+                print("Exiting due to debug mode")
+                break
 
-    else:
-        print(f"inference_stage : sleeping for {sleep_time} seconds")
-        time.sleep(sleep_time)
+        else:
+            print(f"inference_stage : waiting up to {sleep_time} seconds for new jobs")
+            wait_for_job(conn, 'inference', timeout=sleep_time)
+except StopRequested as e:
+    released = release_jobs(conn, held, started=current)
+    print(f"inference_stage : stopped by {e}, returned {released} unfinished jobs to the queue")
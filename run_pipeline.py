@@ -1,32 +1,190 @@
-from multiprocessing import Process
+import os
+import sys
+import time
+import signal
+import socket
 import subprocess
 
-def run_multiple_python(files):
+from config import STAGE_SCRIPTS, STAGE_WORKERS, RESTART_DELAY, MAX_RESTART_DELAY, SHUTDOWN_TIMEOUT
+from config import AUTOSCALE, AUTOSCALE_INTERVAL, STAGE_WORKER_LIMITS, STAGE_CPU_COST, CPU_BUDGET
+from utils.job_queue import get_stage_counts, get_lease_owners
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def plan_workers(counts, limits, cpu_cost, cpu_budget):
     """
-    Run a list of Python files in parallel using multiprocessing.
+    Pick a worker count per stage from queue depth: one worker per pending or
+    running job, clamped to the stage's (min, max). Minimums are always kept;
+    the rest of the CPU budget goes one worker at a time to the stage with
+    the deepest backlog per worker.
+    """
+    demand = {
+        stage: counts.get(stage, {}).get('pending', 0) + counts.get(stage, {}).get('in_progress', 0)
+        for stage in limits
+    }
+    plan = {stage: lo for stage, (lo, hi) in limits.items()}
+    used = sum(plan[stage] * cpu_cost[stage] for stage in plan)
+
+    while True:
+        candidates = [
+            stage for stage, (lo, hi) in limits.items()
+            if plan[stage] < min(hi, demand[stage]) and used + cpu_cost[stage] <= cpu_budget
+        ]
+        if not candidates:
+            break
+        stage = max(candidates, key=lambda st: demand[st] / plan[st] if plan[st] else float('inf'))
+        plan[stage] += 1
+        used += cpu_cost[stage]
+    return plan
 
-    :param files: list of Python script filenames
-    :param n_procs_per_stage: how many times each file should run in parallel
+
+class StageSupervisor:
+    """
+    Keep worker processes alive for every stage at once, so download,
+    character detection, inference and shot description for different titles
+    overlap instead of running as serial barriers. With autoscale on, the
+    per-stage worker counts follow queue depth in pipeline_jobs, read over a
+    connection from connect() that is reopened after any database error.
     """
-    processes = []
 
-    for f in files:
-        p = Process(target=subprocess.run, args=(["python", f],))
-        p.start()
-        processes.append(p)
+    def __init__(self, stage_workers, poll_interval=5, autoscale=False, connect=None):
+        self.stage_workers = dict(stage_workers)
+        self.poll_interval = poll_interval
+        self.autoscale = autoscale
+        self.connect = connect
+        self.conn = None
+        self.workers = {stage: [] for stage in self.stage_workers}
+        self.retiring = []
+        self.crashes = {stage: 0 for stage in self.stage_workers}
+        self.next_start = {stage: 0.0 for stage in self.stage_workers}
+        self.next_scale = 0.0
+        self.stopping = False
+
+    def spawn(self, stage):
+        script = os.path.join(ROOT, STAGE_SCRIPTS[stage])
+        # own session: a terminal Ctrl-C reaches only the supervisor, which then stops
+        # workers with SIGTERM so they can hand their jobs back before exiting
+        proc = subprocess.Popen([sys.executable, script], cwd=ROOT, start_new_session=True)
+        self.workers[stage].append(proc)
+        print(f"▶️  {stage}: started worker pid={proc.pid}")
+        return proc
+
+    def reap(self):
+        """Drop exited workers; crashes push back the next restart of that stage."""
+        now = time.time()
+        self.retiring = [proc for proc in self.retiring if proc.poll() is None]
+        for stage, procs in self.workers.items():
+            alive = []
+            for proc in procs:
+                code = proc.poll()
+                if code is None:
+                    alive.append(proc)
+                    continue
+                if code == 0:
+                    print(f"⏹  {stage}: worker pid={proc.pid} exited")
+                    self.crashes[stage] = 0
+                else:
+                    self.crashes[stage] += 1
+                    delay = min(MAX_RESTART_DELAY, RESTART_DELAY * 2 ** (self.crashes[stage] - 1))
+                    self.next_start[stage] = now + delay
+                    print(f"💥 {stage}: worker pid={proc.pid} crashed with code {code}, restarting in {delay}s")
+            self.workers[stage] = alive
+
+    def fill(self):
+        now = time.time()
+        for stage, target in self.stage_workers.items():
+            if now < self.next_start[stage]:
+                continue
+            while len(self.workers[stage]) < target:
+                self.spawn(stage)
+
+    def rescale(self):
+        """Resize every stage from pipeline_jobs queue depth."""
+        now = time.time()
+        if now < self.next_scale:
+            return
+        self.next_scale = now + AUTOSCALE_INTERVAL
+
+        try:
+            if self.conn is None:
+                self.conn = self.connect()
+            counts = get_stage_counts(self.conn)
+            owners = get_lease_owners(self.conn)
+        except Exception as e:
+            # a dropped connection cannot even be rolled back, so start over next round
+            print(f"⚠️ Autoscale skipped, could not read queue depth: {e}")
+            self.close_conn()
+            return
+
+        plan = plan_workers(counts, STAGE_WORKER_LIMITS, STAGE_CPU_COST, CPU_BUDGET)
+        if plan != self.stage_workers:
+            print(f"📈 Autoscale: {self.stage_workers} -> {plan}")
+        self.stage_workers = plan
+
+        # only retire workers that hold no lease, so nothing in flight is killed
+        host = socket.gethostname()
+        for stage, target in plan.items():
+            excess = len(self.workers[stage]) - target
+            if excess <= 0:
+                continue
+            idle = [proc for proc in self.workers[stage] if f"{host}:{proc.pid}" not in owners]
+            for proc in idle[:excess]:
+                print(f"📉 {stage}: retiring idle worker pid={proc.pid}")
+                proc.terminate()
+                self.workers[stage].remove(proc)
+                self.retiring.append(proc)
+
+    def close_conn(self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except Exception:
+                pass
+        self.conn = None
+
+    def shutdown(self):
+        procs = [proc for procs in self.workers.values() for proc in procs if proc.poll() is None]
+        procs += [proc for proc in self.retiring if proc.poll() is None]
+        print(f"\n🛑 Stopping {len(procs)} workers...")
+        for proc in procs:
+            proc.terminate()
+
+        deadline = time.time() + SHUTDOWN_TIMEOUT
+        for proc in procs:
+            try:
+                proc.wait(timeout=max(0, deadline - time.time()))
+            except subprocess.TimeoutExpired:
+                print(f"Killing unresponsive worker pid={proc.pid}")
+                # the worker leads its own process group, so this also takes down its pool processes
+                try:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                proc.wait()
+
+    def request_stop(self, signum, frame):
+        self.stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGINT, self.request_stop)
+        signal.signal(signal.SIGTERM, self.request_stop)
+        try:
+            while not self.stopping:
+                self.reap()
+                if self.autoscale:
+                    self.rescale()
+                self.fill()
+                time.sleep(self.poll_interval)
+        finally:
+            self.shutdown()
+            self.close_conn()
+        print("🏁 Pipeline supervisor stopped.")
 
-    for p in processes:
-        p.join()  # wait for all files to finish
 
 if __name__ == "__main__":
-    n_procs_per_stage = 3
-    files = [
-        "download_stage.py",
-        "character_detection_stage.py",
-        "inference_stage.py",
-        "shot_description_stage.py"
-    ]
-    run_multiple_python(["download_stage.py"]* n_procs_per_stage )
-    run_multiple_python(["character_detection_stage.py"] * n_procs_per_stage)
-    run_multiple_python(["inference_stage.py"] * n_procs_per_stage)
-    run_multiple_python(["shot_description_stage.py"] * n_procs_per_stage)
+    connect = None
+    if AUTOSCALE:
+        from utils.aud_db_utils import get_pg_conn
+        connect = get_pg_conn
+    StageSupervisor(STAGE_WORKERS, autoscale=AUTOSCALE, connect=connect).run()
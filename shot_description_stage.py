@@ -2,7 +2,7 @@ import os
 import time
 
 from utils.describe_shots import process_shots
-from utils.job_queue import update_job_stage, fetch_next_job, mark_job_failed
+from utils.job_queue import update_job_stage, fetch_next_jobs, mark_job_failed, wait_for_job, start_job, keep_lease_alive, retry_job, stop_on_signals, release_jobs, StopRequested, batch_size
 from config import SLEEP_DURATION, DEBUG_MODE,PROMPT_TEMPLATES_DIR, MAX_WORKERS
 from utils.aud_db_utils import get_pg_conn
 
@@ -11,35 +11,55 @@ debug = DEBUG_MODE
 sleep_time = SLEEP_DURATION
 status = "pending"
 
-while True:
-    job = fetch_next_job(conn, 'shot_description', status=status) 
+stop_on_signals()
+held, current = set(), None
+try:
+    while True:
+        jobs = fetch_next_jobs(conn, 'shot_description', batch_size('shot_description'), status=status) 
     
-    if job:
-        # try:
-        start = time.time()
-        
-        local_path = job.get('local_path', None)
-        if local_path:
+        if jobs:
+            # heartbeat the whole batch, so queued jobs keep their lease while earlier ones run
+            held = {job['id'] for job in jobs}
+            with keep_lease_alive(held):
+                for job in jobs:
+                    if not start_job(conn, job):
+                        # the lease on a queued job expired and another worker reclaimed it
+                        print("Lease lost, skipping job:", job['id'])
+                        held.discard(job['id'])
+                        continue
+                    current = job['id']
+                    try:
+                        start = time.time()
             
-            dir_path = os.path.dirname(local_path)
-            video_name = os.path.splitext(os.path.basename(local_path))[0]
-            combined = os.path.join(dir_path, video_name)
+                        local_path = job.get('local_path', None)
+                        if local_path:
+                
+                            dir_path = os.path.dirname(local_path)
+                            video_name = os.path.splitext(os.path.basename(local_path))[0]
+                            combined = os.path.join(dir_path, video_name)
 
-            print("\nlocal_path : ", local_path, combined, "\n")
-            process_shots(combined, PROMPT_TEMPLATES_DIR, max_workers=MAX_WORKERS)
-            shot_description_time = time.time() - start
+                            print("\nlocal_path : ", local_path, combined, "\n")
+                            process_shots(combined, PROMPT_TEMPLATES_DIR, max_workers=MAX_WORKERS)
+                            shot_description_time = time.time() - start
 
-            update_job_stage(conn, job['id'], 'scene_detection', new_status='pending', addons=[f"local_path = '{local_path}'", f"shot_description_time = {shot_description_time:0.2f}"])
-        else:
-            mark_job_failed(conn, job['id'])
-            raise ValueError("No local_path found in job")
-       
-        # except Exception as e:
-        #     print("Download failed for:", e)
+                            update_job_stage(conn, job['id'], 'scene_detection', new_status='pending', addons=[f"local_path = '{local_path}'", f"shot_description_time = {shot_description_time:0.2f}"])
+                        else:
+                            # the rest of the claimed batch is still in_progress, so keep going instead of raising
+                            print("No local_path found in job:", job['id'])
+                            mark_job_failed(conn, job['id'], error="No local_path found in job")
+                    except Exception as e:
+                        print("Shot description failed for:", job['id'], e)
+                        retry_job(conn, job, e)
+                    # not a finally: a job interrupted by StopRequested stays held so it is released
+                    held.discard(job['id'])
+                    current = None
 
-        if debug:
-            print("Exiting due to debug mode")
-            break
-    else:
-        print("Sleeping for 3 mins")
-        time.sleep(sleep_time)
+            if debug:
+                print("Exiting due to debug mode")
+                break
+        else:
+            print(f"shot_description_stage : waiting up to {sleep_time} seconds for new jobs")
+            wait_for_job(conn, 'shot_description', timeout=sleep_time)
+except StopRequested as e:
+    released = release_jobs(conn, held, started=current)
+    print(f"shot_description_stage : stopped by {e}, returned {released} unfinished jobs to the queue")
@@ -6,6 +6,8 @@ from google import genai
 from datetime import datetime
 from google.genai.types import HttpOptions
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from utils.rate_limit import get_limiter, estimate_tokens
+from utils.response_cache import get_cache, request_key, is_json_response
 
 
 client = genai.Client(
@@ -102,11 +104,11 @@ def generate_shot_wise_text(shots_json, excel_desc, excel_summary, output_file=N
 def call_gemini(shot_text, prompt_template):
     prompt = prompt_template.replace("{{shots_text}}", shot_text)
     
-    response = client.models.generate_content(
-        model="gemini-2.5-flash",
+    model = "gemini-2.5-flash"
+    return get_cache().cached(request_key(model, None, prompt), lambda: get_limiter().call(lambda: client.models.generate_content(
+        model=model,
         contents=prompt,
-    )
-    return response.text
+    ), tokens=estimate_tokens(prompt)).text, valid=is_json_response)
 
 
 def extract_and_save_json(text: str, output_path: str = None) -> dict:
@@ -222,6 +224,7 @@ def process_shots(
         json.dump(final_json, f, indent=4, ensure_ascii=False)
 
     print("\n✓ Saved → shots_gemini_output.json")
+    get_cache().report()
     save_shots_to_excel(final_json, os.path.join(output_dir, "shots_gemini_output.xlsx"))
 
 
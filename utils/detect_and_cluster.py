@@ -1,11 +1,24 @@
 import os
+import json
 import glob
+import time
+import math
+import zipfile
 import cv2
 import numpy as np
 from tqdm import tqdm
 import insightface
+from insightface.utils import face_align
 from sklearn.cluster import DBSCAN
-from collections import defaultdict
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+from collections import defaultdict, deque
+from itertools import islice
+from functools import partial
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import onnxruntime
 
 # ---------------------------------
 def ensure_dir(p): os.makedirs(p, exist_ok=True)
@@ -16,33 +29,329 @@ def id_color(label):
 # ---------------------------------
 
 
-def extract_faces(frames_dir, face_app):
-    """Detect faces, store bbox + embedding per frame"""
-    frame_paths = sorted(
+def list_frames(frames_dir):
+    return sorted(
         glob.glob(os.path.join(frames_dir, "*.jpg")) +
         glob.glob(os.path.join(frames_dir, "*.png")) +
         glob.glob(os.path.join(frames_dir, "*.jpeg"))
     )
 
-    all_faces = []
-    for idx, fpath in enumerate(tqdm(frame_paths, desc="🔍 Detecting faces")):
-        img = cv2.imread(fpath)
-        faces = face_app.get(img)
 
-        for face in faces:
-            x1, y1, x2, y2 = map(int, face.bbox)
+def prefetch(executor, fn, items, depth):
+    """Like executor.map, but keeps at most `depth` results in flight."""
+    items = iter(items)
+    futures = deque(executor.submit(fn, item) for item in islice(items, depth))
+    while futures:
+        result = futures.popleft().result()
+        for item in islice(items, 1):
+            futures.append(executor.submit(fn, item))
+        yield result
+
+
+class FrameStore:
+    """
+    Decoded frames of one title, shared by extract_faces, annotate_frames and
+    save_cluster_crops so a frame is not decoded three times. Holds at most
+    budget_mb of uint8 arrays. Every pass walks the frames in order, where an
+    LRU would evict each frame just before the next pass reaches it, so
+    frames stay cached once admitted and only the overflow is re-decoded.
+    Cached arrays are shared: copy before drawing on them.
+    """
+
+    def __init__(self, budget_mb=2048):
+        self.budget = budget_mb * 1024 * 1024
+        self.frames = {}
+        self.used = 0
+        self.hits = 0
+        self.decodes = 0
+        self._lock = threading.Lock()
+
+    def get(self, fpath):
+        with self._lock:
+            img = self.frames.get(fpath)
+            if img is not None:
+                self.hits += 1
+                return img
+
+        img = cv2.imread(fpath)
+        with self._lock:
+            self.decodes += 1
+            if img is not None and fpath not in self.frames and self.used + img.nbytes <= self.budget:
+                self.frames[fpath] = img
+                self.used += img.nbytes
+        return img
+
+    def report(self):
+        print(f"   🔹 frame store: {self.decodes} decodes, {self.hits} hits, {self.used / 2**20:.0f} MB cached")
+
+    def clear(self):
+        with self._lock:
+            self.frames.clear()
+            self.used = 0
+
+
+class FaceEngine:
+    """
+    buffalo_l detection + recognition loaded once and reused for every title.
+
+    Frames are decoded on background threads, detection runs per frame and
+    the aligned face crops are embedded in batches of batch_size across
+    frames, which is where FaceAnalysis.get loses most of its time.
+    """
+
+    def __init__(self, name="buffalo_l", providers=("CoreMLExecutionProvider", "CPUExecutionProvider"),
+                 det_size=(640, 640), batch_size=32, prefetch=4, intra_op_threads=None):
+        self.app = insightface.app.FaceAnalysis(
+            name=name, providers=list(providers), allowed_modules=["detection", "recognition"]
+        )
+        self.app.prepare(ctx_id=0, det_size=det_size)
+        self.det_model = self.app.det_model
+        self.rec_model = self.app.models["recognition"]
+
+        if intra_op_threads:
+            # insightface does not take session options, so rebuild the sessions with a thread cap
+            options = onnxruntime.SessionOptions()
+            options.intra_op_num_threads = intra_op_threads
+            options.inter_op_num_threads = 1
+            for model in (self.det_model, self.rec_model):
+                model.session = onnxruntime.InferenceSession(
+                    model.model_file, sess_options=options, providers=list(providers)
+                )
+
+        self.batch_size = batch_size
+        self.prefetch = prefetch
+        self.timings = defaultdict(float)
+        self._timings_lock = threading.Lock()
+
+    def _load(self, fpath, read=cv2.imread):
+        start = time.time()
+        img = read(fpath)
+        with self._timings_lock:
+            self.timings["decode"] += time.time() - start
+        return img
+
+    def _embed(self, pending, all_faces):
+        start = time.time()
+        feats = self.rec_model.get_feat([crop for _, _, crop in pending])
+        self.timings["embed"] += time.time() - start
+        feats = feats / np.linalg.norm(feats, axis=1, keepdims=True)
+        for (frame_idx, bbox, _), emb in zip(pending, feats):
             all_faces.append({
-                "frame_idx": idx,
-                "bbox": [x1, y1, x2, y2],
-                "embedding": face.normed_embedding
+                "frame_idx": frame_idx,
+                "bbox": bbox,
+                "embedding": emb
             })
+        pending.clear()
+
+    def extract(self, frame_paths, load=None, start_idx=0, progress=True):
+        """Detect faces, store bbox + embedding per frame. load(fpath) replaces cv2.imread, e.g. FrameStore.get"""
+        load = partial(self._load, read=load) if load else self._load
+        image_size = self.rec_model.input_size[0]
+        all_faces = []
+        pending = []
+
+        with ThreadPoolExecutor(max_workers=self.prefetch) as executor:
+            frames = prefetch(executor, load, frame_paths, depth=self.prefetch * 2)
+            if progress:
+                frames = tqdm(frames, total=len(frame_paths), desc="🔍 Detecting faces")
+            for idx, img in enumerate(frames, start_idx):
+                start = time.time()
+                bboxes, kpss = self.det_model.detect(img, max_num=0, metric="default")
+                self.timings["detect"] += time.time() - start
+                if bboxes.shape[0] == 0:
+                    continue
+
+                start = time.time()
+                for bbox, kps in zip(bboxes, kpss):
+                    x1, y1, x2, y2 = map(int, bbox[:4])
+                    crop = face_align.norm_crop(img, landmark=kps, image_size=image_size)
+                    pending.append((idx, [x1, y1, x2, y2], crop))
+                self.timings["align"] += time.time() - start
+
+                if len(pending) >= self.batch_size:
+                    self._embed(pending, all_faces)
+
+        if pending:
+            self._embed(pending, all_faces)
+        return all_faces
+
+    def report(self):
+        print("\n⏱️  Face analysis timing")
+        for stage in ("decode", "detect", "align", "embed"):
+            print(f"   🔹 {stage}: {self.timings[stage]:.2f}s")
+        self.timings.clear()
+
+
+_worker_engine = None
+
+
+def _init_face_worker(engine_kwargs):
+    global _worker_engine
+    _worker_engine = FaceEngine(**engine_kwargs)
+
+
+def _extract_shard(frame_paths, start_idx):
+    faces = _worker_engine.extract(frame_paths, start_idx=start_idx, progress=False)
+    timings = dict(_worker_engine.timings)
+    _worker_engine.timings.clear()
+    return faces, timings
+
+
+class FacePool:
+    """
+    A pool of worker processes, each holding its own warm FaceEngine with a
+    capped ONNX intra-op thread count. extract() shards the frame list into
+    contiguous runs and merges the faces back in frame order. If a worker
+    dies (OOM, native crash) the pool is rebuilt and extract() re-raises, so
+    only that title is retried and the next one gets fresh workers.
+    """
+
+    def __init__(self, workers, intra_op_threads=1, shards_per_worker=4, **engine_kwargs):
+        engine_kwargs["intra_op_threads"] = intra_op_threads
+        self.workers = workers
+        self.shards_per_worker = shards_per_worker
+        self.engine_kwargs = engine_kwargs
+        self.executor = self._new_executor()
+        self.timings = defaultdict(float)
+
+    def _new_executor(self):
+        return ProcessPoolExecutor(
+            max_workers=self.workers, initializer=_init_face_worker, initargs=(self.engine_kwargs,)
+        )
+
+    def extract(self, frame_paths, progress=True):
+        try:
+            return self._extract(frame_paths, progress)
+        except BrokenProcessPool:
+            print("⚠️ A face worker died, restarting the face pool")
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = self._new_executor()
+            raise
+
+    def _extract(self, frame_paths, progress):
+        num_shards = max(1, min(len(frame_paths), self.workers * self.shards_per_worker))
+        step = math.ceil(len(frame_paths) / num_shards) if frame_paths else 1
+        futures = [
+            self.executor.submit(_extract_shard, frame_paths[start:start + step], start)
+            for start in range(0, len(frame_paths), step)
+        ]
+
+        all_faces = []
+        if progress:
+            futures_iter = tqdm(futures, desc=f"🔍 Detecting faces ({self.workers} procs)")
+        else:
+            futures_iter = futures
+        for future in futures_iter:
+            faces, timings = future.result()
+            all_faces.extend(faces)
+            for stage, seconds in timings.items():
+                self.timings[stage] += seconds
+        return all_faces
+
+    def report(self):
+        print("\n⏱️  Face analysis timing (summed over workers)")
+        for stage in ("decode", "detect", "align", "embed"):
+            print(f"   🔹 {stage}: {self.timings[stage]:.2f}s")
+        self.timings.clear()
+
+    def close(self):
+        self.executor.shutdown()
+
+
+def extract_faces(frames_dir, face_engine, store=None):
+    """
+    Detect faces, store bbox + embedding per frame. A FaceEngine fills the
+    FrameStore as it decodes; FacePool workers decode in their own processes.
+    """
+    frame_paths = list_frames(frames_dir)
+    if store is not None and isinstance(face_engine, FaceEngine):
+        all_faces = face_engine.extract(frame_paths, load=store.get)
+    else:
+        all_faces = face_engine.extract(frame_paths)
     return all_faces, frame_paths
 
 
-def cluster_faces(all_faces, eps=0.55, min_samples=4):
+def _unit_rows(embeddings):
+    x = np.asarray(embeddings, dtype=np.float32)
+    return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+
+def chunked_dbscan(embeddings, eps=0.55, min_samples=4, chunk_size=1024):
+    """
+    DBSCAN(metric="cosine") without the n x n neighborhood lists. Cosine
+    similarities are computed one block of chunk_size rows at a time as
+    float32 dot products, so memory stays at chunk_size x n:
+      1. count neighbors per face to find the core points
+      2. walk the core rows again, merging core points closer than eps into
+         connected components and noting which components each border
+         point touches
+    A border point takes the lowest cluster label among its core neighbors,
+    and clusters are numbered by their lowest-index core point, which is how
+    sklearn's in-order expansion labels them.
+    """
+    x = _unit_rows(embeddings)
+    n = len(x)
+    min_sim = 1.0 - eps
+
+    counts = np.empty(n, dtype=np.int64)
+    for start in range(0, n, chunk_size):
+        counts[start:start + chunk_size] = (x[start:start + chunk_size] @ x.T >= min_sim).sum(axis=1)
+    is_core = counts >= min_samples
+    core_idx = np.flatnonzero(is_core)
+    labels = np.full(n, -1, dtype=np.int64)
+    m = len(core_idx)
+    if m == 0:
+        return labels
+
+    # comp[i] is the component of the i-th core point; each block only adds
+    # the distinct component pairs it links, which stays small
+    core_pos = np.cumsum(is_core) - 1
+    comp = np.arange(m)
+    border_hits, border_cores = [], []
+    for start in range(0, m, chunk_size):
+        rows, cols = np.nonzero(x[core_idx[start:start + chunk_size]] @ x.T >= min_sim)
+        rows += start
+
+        core_col = is_core[cols]
+        pairs = np.unique(comp[rows[core_col]] * m + comp[core_pos[cols[core_col]]])
+        graph = csr_matrix((np.ones(len(pairs), dtype=np.int8), (pairs // m, pairs % m)), shape=(m, m))
+        _, merged = connected_components(graph, directed=False)
+        comp = merged[comp]
+
+        # one core neighbor per (border point, component) is enough
+        hits, rows = cols[~core_col], rows[~core_col]
+        _, keep = np.unique(hits * m + comp[rows], return_index=True)
+        border_hits.append(hits[keep])
+        border_cores.append(rows[keep])
+
+    roots, first = np.unique(comp, return_index=True)
+    order = np.empty(len(roots), dtype=np.int64)
+    order[np.argsort(first)] = np.arange(len(roots))
+    core_labels = order[np.searchsorted(roots, comp)]
+    labels[core_idx] = core_labels
+
+    hits, cores = np.concatenate(border_hits), np.concatenate(border_cores)
+    best = np.full(n, m, dtype=np.int64)
+    np.minimum.at(best, hits, core_labels[cores])
+    border = ~is_core & (best < m)
+    labels[border] = best[border]
+    return labels
+
+
+def cluster_labels(embeddings, eps=0.55, min_samples=4, engine="dbscan"):
+    """Raw DBSCAN labels; engine="chunked" gives the same labels through chunked_dbscan."""
+    if engine == "chunked":
+        return chunked_dbscan(embeddings, eps=eps, min_samples=min_samples)
+    return DBSCAN(eps=eps, min_samples=min_samples, metric="cosine").fit(embeddings).labels_
+
+
+def cluster_faces(all_faces, eps=0.55, min_samples=4, engine="dbscan"):
+    if not all_faces:
+        print("✔ No faces to cluster")
+        return all_faces
+
     embeddings = np.stack([f["embedding"] for f in all_faces])
-    clustering = DBSCAN(eps=eps, min_samples=min_samples, metric="cosine").fit(embeddings)
-    raw_labels = clustering.labels_
+    raw_labels = cluster_labels(embeddings, eps=eps, min_samples=min_samples, engine=engine)
 
     # Convert raw DBSCAN labels (-1, 0, 1, 2, ...) to 1-based char_<N> labels
     unique = sorted(list(set(raw_labels)))
@@ -60,16 +369,18 @@ def cluster_faces(all_faces, eps=0.55, min_samples=4):
     return all_faces
 
 
-def annotate_frames(all_faces, frame_paths, save_dir):
+def annotate_frames(all_faces, frame_paths, save_dir, store=None):
     """Draw bounding box + cluster label"""
     ensure_dir(save_dir)
+    read = store.get if store is not None else cv2.imread
     faces_by_frame = defaultdict(list)
     for f in all_faces: faces_by_frame[f["frame_idx"]].append(f)
 
     for idx, fpath in enumerate(tqdm(frame_paths, desc="🖊 Annotating frames")):
-        img = cv2.imread(fpath)
+        img = read(fpath)
 
         if idx in faces_by_frame:
+            img = img.copy()
             for f in faces_by_frame[idx]:
                 x1, y1, x2, y2 = f["bbox"]
                 label = f["cluster"]
@@ -83,26 +394,96 @@ def annotate_frames(all_faces, frame_paths, save_dir):
     print(f"📌 Annotated frames saved to: {save_dir}")
 
 
-def save_cluster_crops(all_faces, frames_dir, save_root):
-    """Crop and save faces per cluster"""
+def save_face_overlay(all_faces, frame_paths, out_path):
+    """Boxes and cluster ids as {frame file: [[cluster, x1, y1, x2, y2], ...]}, the data annotate_frames draws."""
+    overlay = defaultdict(list)
+    for f in all_faces:
+        overlay[os.path.basename(frame_paths[f["frame_idx"]])].append([f["cluster"], *f["bbox"]])
+    with open(out_path, "w") as fp:
+        json.dump(overlay, fp, separators=(",", ":"))
+    print(f"📌 Face overlay saved to: {out_path}")
+
+
+class ContactSheet:
+    """
+    Packs the face crops of one cluster into grid JPEGs of rows x cols tiles
+    (sheet_000.jpg, ...), each with a JSON index of the frame and bbox behind
+    every tile, instead of one small file per crop.
+    """
+
+    def __init__(self, out_dir, tile=112, cols=10, rows=10):
+        self.out_dir = out_dir
+        self.tile = tile
+        self.cols = cols
+        self.per_sheet = cols * rows
+        self.tiles = []
+        self.index = []
+        self.num_sheets = 0
+
+    def add(self, crop, frame_idx, bbox):
+        """Returns (path, image) for the caller to write once a sheet fills up."""
+        self.tiles.append(cv2.resize(crop, (self.tile, self.tile), interpolation=cv2.INTER_AREA))
+        self.index.append({"frame_idx": frame_idx, "bbox": bbox})
+        if len(self.tiles) == self.per_sheet:
+            return self.flush()
+        return None
+
+    def flush(self):
+        if not self.tiles:
+            return None
+        rows = math.ceil(len(self.tiles) / self.cols)
+        sheet = np.zeros((rows * self.tile, self.cols * self.tile, 3), dtype=np.uint8)
+        for i, tile in enumerate(self.tiles):
+            r, c = divmod(i, self.cols)
+            sheet[r * self.tile:(r + 1) * self.tile, c * self.tile:(c + 1) * self.tile] = tile
+
+        name = f"sheet_{self.num_sheets:03d}"
+        with open(os.path.join(self.out_dir, f"{name}.json"), "w") as fp:
+            json.dump({"tile": self.tile, "cols": self.cols, "faces": self.index}, fp)
+        self.num_sheets += 1
+        self.tiles, self.index = [], []
+        return os.path.join(self.out_dir, f"{name}.jpg"), sheet
+
+
+def _write_zip_crop(archive, lock, name, crop):
+    ok, buf = cv2.imencode(".jpg", crop)
+    if ok:
+        with lock:
+            archive.writestr(name, buf.tobytes())
+
+
+def save_cluster_crops(all_faces, frames_dir, save_root, store=None, crop_format="jpg", writers=8):
+    """
+    Crop and save faces per cluster, walking the frames in order with one decoded frame at a time.
+    crop_format: "jpg" writes <cluster>/<frame_idx>_<n>.jpg, "sheet" packs each
+                 cluster into ContactSheet grids, "zip" writes one <cluster>.zip
+    Crop numbers come from per-cluster counters and the JPEG encodes run on
+    `writers` threads.
+    """
     ensure_dir(save_root)
-    frame_cache = {}
-    frame_paths = sorted(
-        glob.glob(os.path.join(frames_dir, "*.jpg")) +
-        glob.glob(os.path.join(frames_dir, "*.png")) +
-        glob.glob(os.path.join(frames_dir, "*.jpeg"))
-    )
-
-    for f in tqdm(all_faces, desc="💾 Saving cropped faces"):
+    read = store.get if store is not None else cv2.imread
+    frame_paths = list_frames(frames_dir)
+    img, img_idx = None, None
+
+    counts = defaultdict(int)
+    sheets = {}
+    archives = {}
+    archive_lock = threading.Lock()
+    executor = ThreadPoolExecutor(max_workers=writers)
+    in_flight = deque()
+
+    def submit(fn, *args):
+        in_flight.append(executor.submit(fn, *args))
+        while len(in_flight) > writers * 4:
+            in_flight.popleft().result()
+
+    for f in tqdm(sorted(all_faces, key=lambda f: f["frame_idx"]), desc="💾 Saving cropped faces"):
         cname = f["cluster"]
-        out_dir = os.path.join(save_root, cname)
-        ensure_dir(out_dir)
 
         frame_idx = f["frame_idx"]
-        if frame_idx not in frame_cache:
-            frame_cache[frame_idx] = cv2.imread(frame_paths[frame_idx])
+        if frame_idx != img_idx:
+            img, img_idx = read(frame_paths[frame_idx]), frame_idx
 
-        img = frame_cache[frame_idx]
         h, w = img.shape[:2]
 
         x1, y1, x2, y2 = f["bbox"]
@@ -119,26 +500,67 @@ def save_cluster_crops(all_faces, frames_dir, save_root):
         if crop.size == 0 or crop.shape[0] < 10 or crop.shape[1] < 10:
             continue
 
-        count = len(os.listdir(out_dir))
-        cv2.imwrite(os.path.join(out_dir, f"{frame_idx}_{count}.jpg"), crop)
-
-    print(f"📁 Clustered faces stored in: {save_root}")
+        name = f"{frame_idx}_{counts[cname]}.jpg"
+        counts[cname] += 1
 
+        if crop_format == "zip":
+            if cname not in archives:
+                archives[cname] = zipfile.ZipFile(os.path.join(save_root, f"{cname}.zip"), "w", zipfile.ZIP_STORED)
+            submit(_write_zip_crop, archives[cname], archive_lock, name, crop)
+            continue
 
-def process_video_faces(out_dir):
+        out_dir = os.path.join(save_root, cname)
+        if counts[cname] == 1:
+            ensure_dir(out_dir)
+
+        if crop_format == "sheet":
+            if cname not in sheets:
+                sheets[cname] = ContactSheet(out_dir)
+            full = sheets[cname].add(crop, frame_idx, f["bbox"])
+            if full:
+                submit(cv2.imwrite, *full)
+        else:
+            submit(cv2.imwrite, os.path.join(out_dir, name), crop)
+
+    for sheet in sheets.values():
+        last = sheet.flush()
+        if last:
+            submit(cv2.imwrite, *last)
+    for future in in_flight:
+        future.result()
+    executor.shutdown()
+    for archive in archives.values():
+        archive.close()
+
+    print(f"📁 {sum(counts.values())} faces in {len(counts)} clusters stored in: {save_root}")
+
+
+def process_video_faces(out_dir, face_engine=None, cluster_engine="dbscan", frame_cache_mb=2048, crop_format="jpg", crop_writers=8, annotate=True):
+    """
+    Pass a long-lived FaceEngine or FacePool to reuse loaded models across titles.
+    frame_cache_mb bounds the decoded frames shared by the three passes;
+    crop_format and crop_writers go to save_cluster_crops. faces.json is
+    always written; annotate=False skips redrawing the frames, and
+    get_meta_data then sends frames/ with that overlay instead.
+    """
     frames_dir = os.path.join(out_dir, "frames")
     annotated_frames_dir = os.path.join(out_dir, "annotated_frames")
     cluster_face_out =  os.path.join(out_dir, "clustered_faces")
 
-    face_app = insightface.app.FaceAnalysis(
-        name="buffalo_l", providers=["CoreMLExecutionProvider", "CPUExecutionProvider"]
-    )
-    face_app.prepare(ctx_id=0, det_size=(640, 640))
+    face_engine = face_engine or FaceEngine()
+
+    store = FrameStore(frame_cache_mb)
 
-    all_faces, frame_paths = extract_faces(frames_dir, face_app)
-    all_faces = cluster_faces(all_faces)
-    annotate_frames(all_faces, frame_paths, annotated_frames_dir)
-    save_cluster_crops(all_faces, frames_dir=frames_dir, save_root=cluster_face_out)
+    all_faces, frame_paths = extract_faces(frames_dir, face_engine, store=store)
+    face_engine.report()
+    all_faces = cluster_faces(all_faces, engine=cluster_engine)
+    save_face_overlay(all_faces, frame_paths, os.path.join(out_dir, "faces.json"))
+    if annotate:
+        annotate_frames(all_faces, frame_paths, annotated_frames_dir, store=store)
+    save_cluster_crops(all_faces, frames_dir=frames_dir, save_root=cluster_face_out, store=store,
+                       crop_format=crop_format, writers=crop_writers)
+    store.report()
+    store.clear()
     
 
 
@@ -1,4 +1,5 @@
 import os
+import json
 import glob
 import cv2
 import numpy as np
@@ -18,11 +19,63 @@ def cosine_similarity(a, b):
     return np.sum(a * b, axis=1)
 
 
-def build_character_db(char_root, face_app):
-    character_db = {}
-    for char_name in os.listdir(char_root):
+def _load_embedding_index(index_dir, model_name):
+    """Previous {relpath: (mtime, embedding or None)} from index_dir, empty if missing or built by another model."""
+    manifest_path = os.path.join(index_dir, "manifest.json")
+    if not os.path.exists(manifest_path):
+        return {}
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest.get("model") != model_name:
+            return {}
+        embeddings = np.load(os.path.join(index_dir, "embeddings.npy"))
+    except Exception as e:
+        print(f"⚠️ Ignoring unreadable embedding index in {index_dir}: {e}")
+        return {}
+    return {
+        path: (entry["mtime"], None if entry["row"] is None else embeddings[entry["row"]])
+        for path, entry in manifest["files"].items()
+    }
+
+
+def _save_embedding_index(index_dir, model_name, entries):
+    ensure_dir(index_dir)
+    rows, files = [], {}
+    for path, (mtime, emb) in sorted(entries.items()):
+        files[path] = {"mtime": mtime, "row": None if emb is None else len(rows)}
+        if emb is not None:
+            rows.append(emb)
+    embeddings = np.stack(rows).astype(np.float32) if rows else np.zeros((0, 512), dtype=np.float32)
+
+    # write next to the index and swap in, so a crash never leaves a half-written index
+    tmp_npy = os.path.join(index_dir, "embeddings.tmp.npy")
+    tmp_manifest = os.path.join(index_dir, "manifest.tmp.json")
+    np.save(tmp_npy, embeddings)
+    with open(tmp_manifest, "w") as f:
+        json.dump({"model": model_name, "files": files}, f)
+    os.replace(tmp_npy, os.path.join(index_dir, "embeddings.npy"))
+    os.replace(tmp_manifest, os.path.join(index_dir, "manifest.json"))
+
+
+def build_character_db(char_root, face_app, index_dir=None, model_name="buffalo_l"):
+    """
+    Reference faces of every character stacked into one normalized matrix:
+    {"names": [...], "embeddings": (N, D), "labels": (N,) index into names}
+
+    Embeddings are cached in index_dir (default <char_root>/.embedding_index)
+    keyed by image path, mtime and model name, so only added or changed
+    reference images go through face_app and removed ones drop out.
+    """
+    index_dir = index_dir or os.path.join(char_root, ".embedding_index")
+    cached = _load_embedding_index(index_dir, model_name)
+    entries = {}
+    computed = 0
+
+    names, blocks = [], []
+    for char_name in sorted(os.listdir(char_root)):
         char_dir = os.path.join(char_root, char_name)
-        if not os.path.isdir(char_dir):
+        if not os.path.isdir(char_dir) or os.path.abspath(char_dir) == os.path.abspath(index_dir):
             continue
 
         img_paths = []
@@ -30,29 +83,58 @@ def build_character_db(char_root, face_app):
             img_paths.extend(glob.glob(os.path.join(char_dir, ext)))
 
         embeddings = []
-        for img_path in img_paths:
-            img = cv2.imread(img_path)
-            faces = face_app.get(img)
-            if len(faces) > 0:
-                embeddings.append(faces[0].normed_embedding)
+        for img_path in sorted(img_paths):
+            key = os.path.relpath(img_path, char_root)
+            mtime = os.path.getmtime(img_path)
+            if key in cached and cached[key][0] == mtime:
+                emb = cached[key][1]
+            else:
+                img = cv2.imread(img_path)
+                faces = face_app.get(img)
+                emb = faces[0].normed_embedding if len(faces) > 0 else None
+                computed += 1
+            entries[key] = (mtime, emb)
+            if emb is not None:
+                embeddings.append(emb)
 
         if embeddings:
-            embeddings = l2_normalize(np.stack(embeddings, axis=0), axis=1)
-            character_db[char_name] = {"embeddings": embeddings}
+            names.append(char_name)
+            blocks.append(l2_normalize(np.stack(embeddings, axis=0), axis=1))
+
+    if computed or entries.keys() != cached.keys():
+        _save_embedding_index(index_dir, model_name, entries)
+    print(f"✔ Character index: {len(entries)} reference images, {computed} embedded, {len(entries) - computed} from cache")
+
+    if not blocks:
+        return {"names": [], "embeddings": np.zeros((0, 512), dtype=np.float32), "labels": np.zeros(0, dtype=np.int64)}
+    return {
+        "names": names,
+        "embeddings": np.concatenate(blocks, axis=0).astype(np.float32),
+        "labels": np.repeat(np.arange(len(blocks)), [len(b) for b in blocks]),
+    }
+
+
+def match_faces_to_characters(face_embs, character_db, sim_threshold=0.35):
+    """
+    Names for a (F, D) batch of normalized face embeddings, from one matrix
+    multiply against every reference face. The best reference face overall
+    belongs to the character with the best per-character maximum.
+    """
+    face_embs = np.asarray(face_embs, dtype=np.float32).reshape(-1, character_db["embeddings"].shape[1])
+    if len(face_embs) == 0 or len(character_db["names"]) == 0:
+        return ["Unknown"] * len(face_embs)
 
-    return character_db
+    sims = face_embs @ character_db["embeddings"].T
+    best = sims.argmax(axis=1)
+    best_sim = sims[np.arange(len(best)), best]
+    return [
+        character_db["names"][character_db["labels"][b]] if sim >= sim_threshold else "Unknown"
+        for b, sim in zip(best, best_sim)
+    ]
 
 
 def match_face_to_character(face_emb, character_db, sim_threshold=0.35):
-    best_name = "Unknown"
-    best_sim = -1
-    for cname, data in character_db.items():
-        sims = cosine_similarity(face_emb, data["embeddings"])
-        max_sim = float(sims.max())
-        if max_sim > best_sim:
-            best_sim = max_sim
-            best_name = cname
-    return best_name if best_sim >= sim_threshold else "Unknown"
+    return match_faces_to_characters(face_emb[None], character_db, sim_threshold)[0]
 
 
 def annotate_frames(input_frames_dir, output_frames_dir, face_app, character_db):
@@ -67,10 +149,10 @@ def annotate_frames(input_frames_dir, output_frames_dir, face_app, character_db)
     for fpath in tqdm(frame_paths, desc="Annotating frames"):
         frame = cv2.imread(fpath)
         faces = face_app.get(frame)
+        names = match_faces_to_characters([face.normed_embedding for face in faces], character_db)
 
-        for face in faces:
+        for face, name in zip(faces, names):
             x1, y1, x2, y2 = map(int, face.bbox)
-            name = match_face_to_character(face.normed_embedding, character_db)
             cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
             cv2.putText(frame, name, (x1, y1 - 10),
                         cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 255, 0), 2)
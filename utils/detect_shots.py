@@ -1,10 +1,25 @@
 import os
 import json
-from scenedetect import VideoManager, SceneManager
+import math
+import subprocess
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from scenedetect import VideoManager, SceneManager, FrameTimecode, open_video
 from scenedetect.detectors import ContentDetector
 
 
-def process_and_split_shots(video_path, output_dir, scene_list, detect_time, total_start):
+def cut_clip(video_path, start_sec, end_sec, output_file):
+    """Stream-copy [start_sec, end_sec] of the source into output_file. Returns an error string or None."""
+    result = subprocess.run([
+        "ffmpeg", "-hide_banner", "-loglevel", "error", "-nostdin", "-y",
+        "-ss", str(start_sec), "-to", str(end_sec), "-i", video_path,
+        "-c", "copy", output_file
+    ], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        return result.stderr.decode(errors="replace").strip() or f"ffmpeg exited with {result.returncode}"
+    return None
+
+
+def process_and_split_shots(video_path, output_dir, scene_list, detect_time, total_start, workers=4):
     import time
     split_start = time.time()
 
@@ -14,22 +29,32 @@ def process_and_split_shots(video_path, output_dir, scene_list, detect_time, tot
     #     print(f"  Scene {i+1}: {start_time.get_timecode()} → {end_time.get_timecode()}")
 
     if scene_list:
-        print(f"\n✂️  Splitting video into '{output_dir}/'...")
-        for i, (start_time, end_time) in enumerate(scene_list):
+        print(f"\n✂️  Splitting video into '{output_dir}/' with {workers} workers...")
+        clips = []
+        for start_time, end_time in scene_list:
             start_sec = round(start_time.get_seconds(), 3)
             end_sec = round(end_time.get_seconds(), 3)
-            duration = end_sec - start_sec
-            if duration <= 0.3:
+            if end_sec - start_sec <= 0.3:
                 continue
+            clips.append((start_sec, end_sec, os.path.join(output_dir, f"shot_{start_sec}_{end_sec}.mp4")))
+
+        failed = []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(cut_clip, video_path, start_sec, end_sec, output_file): (start_sec, end_sec, output_file)
+                for start_sec, end_sec, output_file in clips
+            }
+            for done, future in enumerate(as_completed(futures), 1):
+                start_sec, end_sec, output_file = futures[future]
+                error = future.result()
+                if error:
+                    failed.append(output_file)
+                    print(f"❌ [{done}/{len(clips)}] Failed: {output_file}: {error}")
+                else:
+                    print(f"✅ [{done}/{len(clips)}] Saved: {output_file} ({end_sec - start_sec:.2f}s)")
 
-            output_file = os.path.join(output_dir, f"shot_{start_sec}_{end_sec}.mp4")
-            cmd = (
-                f"ffmpeg -hide_banner -loglevel error "
-                f"-ss {start_sec} -to {end_sec} -i \"{video_path}\" "
-                f"-c copy \"{output_file}\""
-            )
-            os.system(cmd)
-            print(f"✅ Saved: {output_file} ({duration:.2f}s)")
+        if failed:
+            print(f"⚠️ {len(failed)}/{len(clips)} clips failed")
 
         split_time = time.time() - split_start
         print(f"\n✅ All scenes saved in: {output_dir}")
@@ -44,29 +69,27 @@ def process_and_split_shots(video_path, output_dir, scene_list, detect_time, tot
     print(f"   🔹 Total time: {total_time:.2f}s")
 
 
-def detect_and_split_shots(video_path, threshold=30.0):
+def scenes_from_cuts(cut_frames, num_frames, fps):
+    """Turn cut frame numbers into [(start, end), ...] FrameTimecode pairs, like SceneManager.get_scene_list."""
+    if not cut_frames:
+        return []
+    bounds = [0] + sorted(cut_frames) + [num_frames]
+    return [
+        (FrameTimecode(start, fps=fps), FrameTimecode(end, fps=fps))
+        for start, end in zip(bounds[:-1], bounds[1:])
+    ]
+
+
+def save_shots(video_path, scene_list, detect_time=0.0, total_start=0.0, clip_workers=4, write_clips=True):
     """
-    Detects scene cuts and splits the video into separate clips.
-    threshold: higher = less sensitive, lower = more sensitive
+    Write <video>/shots.json and the per-shot clips for a detected scene list.
+    With write_clips=False only the metadata is kept; get_shot_clip and
+    stream_shot_clip cut a clip from the source when something needs it.
     """
-
     dir_path = os.path.dirname(video_path)
     video_name = os.path.splitext(os.path.basename(video_path))[0]
     json_path = os.path.join(dir_path, video_name, "shots.json")
-    
-   
-    # Initialize video & scene managers
-    video_manager = VideoManager([str(video_path)])
-    scene_manager = SceneManager()
-    scene_manager.add_detector(ContentDetector(threshold=threshold))
 
-    # Start video
-    video_manager.start()
-
-    scene_manager.detect_scenes(frame_source=video_manager)
-
-    # Get list of scene timecodes
-    scene_list = scene_manager.get_scene_list()
     scene_json = []
     for i, scene in enumerate(scene_list):
         start_time, end_time = scene
@@ -86,6 +109,10 @@ def detect_and_split_shots(video_path, threshold=30.0):
         json.dump(scene_json, f, indent=4)
     print(f"\n📝 Scene timestamps saved to: {json_path}")
 
+    if not write_clips:
+        print("⏭️  Skipping shot clips, they are cut on demand")
+        return
+
     shots_dir = os.path.join(dir_path, video_name, "shots")
     os.makedirs(shots_dir, exist_ok=True)
 
@@ -93,11 +120,157 @@ def detect_and_split_shots(video_path, threshold=30.0):
         video_path=video_path,
         output_dir=shots_dir,
         scene_list=scene_list,
-        detect_time=0.0,
-        total_start=0.0
+        detect_time=detect_time,
+        total_start=total_start,
+        workers=clip_workers
     )
 
 
+def shot_clip_path(video_path, start_sec, end_sec):
+    dir_path = os.path.dirname(video_path)
+    video_name = os.path.splitext(os.path.basename(video_path))[0]
+    return os.path.join(dir_path, video_name, "shots", f"shot_{start_sec}_{end_sec}.mp4")
+
+
+def get_shot_clip(video_path, start_sec, end_sec, output_file=None):
+    """
+    Path to the clip for a shots.json entry, cutting it from the source
+    video on first use. Takes the start_seconds / end_seconds from shots.json.
+    """
+    output_file = output_file or shot_clip_path(video_path, start_sec, end_sec)
+    if os.path.exists(output_file):
+        return output_file
+
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    root, ext = os.path.splitext(output_file)
+    part_file = f"{root}.part{ext}"
+    error = cut_clip(video_path, start_sec, end_sec, part_file)
+    if error:
+        raise RuntimeError(f"Could not cut {output_file}: {error}")
+    os.replace(part_file, output_file)
+    return output_file
+
+
+def stream_shot_clip(video_path, start_sec, end_sec, chunk_size=1 << 16):
+    """Yield a shot as fragmented MP4 bytes straight from ffmpeg, without writing it to disk."""
+    proc = subprocess.Popen([
+        "ffmpeg", "-hide_banner", "-loglevel", "error", "-nostdin",
+        "-ss", str(start_sec), "-to", str(end_sec), "-i", video_path,
+        "-c", "copy", "-movflags", "frag_keyframe+empty_moov", "-f", "mp4", "pipe:1"
+    ], stdout=subprocess.PIPE)
+    try:
+        while True:
+            chunk = proc.stdout.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        proc.stdout.close()
+        proc.kill()
+        proc.wait()
+
+
+def detect_shots_full(video_path, threshold=30.0):
+    # Initialize video & scene managers
+    video_manager = VideoManager([str(video_path)])
+    scene_manager = SceneManager()
+    scene_manager.add_detector(ContentDetector(threshold=threshold))
+
+    # Start video
+    video_manager.start()
+
+    scene_manager.detect_scenes(frame_source=video_manager)
+
+    # Get list of scene timecodes
+    return scene_manager.get_scene_list()
+
+
+def detect_shots_fast(video_path, threshold=30.0, downscale=4, frame_skip=1):
+    """
+    ContentDetector on downscaled frames through open_video, decoding only
+    every (frame_skip + 1)-th frame. Cuts land on the nearest processed frame,
+    so boundaries can move by up to frame_skip frames.
+    """
+    video = open_video(str(video_path))
+    scene_manager = SceneManager()
+    scene_manager.auto_downscale = False
+    scene_manager.downscale = downscale
+    scene_manager.add_detector(ContentDetector(threshold=threshold))
+    scene_manager.detect_scenes(video=video, frame_skip=frame_skip)
+    return scene_manager.get_scene_list()
+
+
+def _detect_window(video_path, threshold, start_frame, end_frame, warmup_frames, downscale=None, frame_skip=0):
+    """
+    Run ContentDetector over [start_frame - warmup_frames, end_frame) and
+    return the cut frames that fall inside [start_frame, end_frame). The
+    warm-up lets the detector see the frames before the window, so cuts at
+    the boundary and min_scene_len suppression behave as in a serial scan.
+    """
+    video = open_video(str(video_path))
+    begin = max(0, start_frame - warmup_frames)
+    if begin > 0:
+        video.seek(begin)
+
+    scene_manager = SceneManager()
+    if downscale:
+        scene_manager.auto_downscale = False
+        scene_manager.downscale = downscale
+    scene_manager.add_detector(ContentDetector(threshold=threshold))
+    scene_manager.detect_scenes(video=video, end_time=end_frame, frame_skip=frame_skip)
+
+    cuts = [cut.get_frames() for cut in scene_manager.get_cut_list()]
+    return [cut for cut in cuts if start_frame <= cut < end_frame]
+
+
+def detect_shots_parallel(video_path, threshold=30.0, workers=8, overlap_seconds=2.0, downscale=None, frame_skip=0, min_scene_len=15):
+    """
+    Split the timeline into `workers` windows, detect each in its own process
+    and stitch the cuts back together. Each window re-scans overlap_seconds
+    before its start, and cuts closer than min_scene_len frames across a
+    window boundary are dropped the way the serial detector would.
+    """
+    video = open_video(str(video_path))
+    fps = video.frame_rate
+    num_frames = video.duration.get_frames()
+
+    warmup_frames = max(int(overlap_seconds * fps), min_scene_len + 1)
+    step = math.ceil(num_frames / workers)
+    windows = [(start, min(start + step, num_frames)) for start in range(0, num_frames, step)]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(_detect_window, video_path, threshold, start, end, warmup_frames, downscale, frame_skip)
+            for start, end in windows
+        ]
+        window_cuts = [future.result() for future in futures]
+
+    cuts = []
+    for cut in sorted(c for wc in window_cuts for c in wc):
+        if cuts and cut - cuts[-1] < min_scene_len:
+            continue
+        cuts.append(cut)
+    return scenes_from_cuts(cuts, num_frames, fps)
+
+
+def detect_and_split_shots(video_path, threshold=30.0, mode="full", downscale=4, frame_skip=1, workers=8, overlap_seconds=2.0, clip_workers=4, write_clips=True):
+    """
+    Detects scene cuts and splits the video into separate clips.
+    threshold: higher = less sensitive, lower = more sensitive
+    mode: "full" scans every frame, "fast" uses detect_shots_fast,
+          "parallel" uses detect_shots_parallel over `workers` processes
+    """
+    import time
+    total_start = time.time()
+    if mode == "fast":
+        scene_list = detect_shots_fast(video_path, threshold=threshold, downscale=downscale, frame_skip=frame_skip)
+    elif mode == "parallel":
+        scene_list = detect_shots_parallel(video_path, threshold=threshold, workers=workers, overlap_seconds=overlap_seconds)
+    else:
+        scene_list = detect_shots_full(video_path, threshold=threshold)
+    save_shots(video_path, scene_list, detect_time=time.time() - total_start, total_start=total_start, clip_workers=clip_workers, write_clips=write_clips)
+
+
 if __name__ == "__main__":
     video_path = '/Users/amana1/working_dir/sample_videos/TX_MASTER_FC_Anupamaa_SH4164_S1_E1599_DYN1492441_v2_763507606_900790931_877219001.mp4'
     threshold = 30.0
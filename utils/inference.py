@@ -1,4 +1,5 @@
 import re
+import asyncio
 import subprocess
 from collections import defaultdict
 import json
@@ -12,6 +13,8 @@ from concurrent.futures import ThreadPoolExecutor, as_completed
 from google import genai
 from google.genai import types
 from google.genai.types import HttpOptions
+from utils.rate_limit import get_limiter, estimate_tokens
+from utils.response_cache import get_cache, request_key, is_json_response
 
 
 class VideoFrameAudioContextAnalyzer:
@@ -27,6 +30,8 @@ class VideoFrameAudioContextAnalyzer:
         
         self.model = model
         self.temperature = temperature
+        self.limiter = get_limiter()
+        self.cache = get_cache()
         self.generate_content_config = types.GenerateContentConfig(
                         temperature = self.temperature,
                         top_p = 0.95,
@@ -49,19 +54,51 @@ class VideoFrameAudioContextAnalyzer:
                         )
 
 
+    def transcription_contents(self, audio_path: str):
+        with open(audio_path, "rb") as f:
+            return [{"role": "user", "parts": [
+                {"text": "Please provide an accurate transcript of this audio clip."},
+                {"inline_data": {"mime_type": "audio/wav", "data": f.read()}}
+            ]}]
+
+    def generate(self, contents, valid=bool):
+        """Response text for contents, from the response cache or a rate-limited Gemini call."""
+        key = request_key(self.model, self.generate_content_config, contents)
+        return self.cache.cached(key, lambda: self.limiter.call(lambda: self.client.models.generate_content(
+            model=self.model,
+            contents=contents,
+            config=self.generate_content_config
+        ), tokens=estimate_tokens(contents)).text, valid=valid)
+
+    async def generate_async(self, contents, valid=bool):
+        """generate() on the async client."""
+        key = request_key(self.model, self.generate_content_config, contents)
+
+        async def call():
+            response = await self.limiter.call_async(lambda: self.client.aio.models.generate_content(
+                model=self.model,
+                contents=contents,
+                config=self.generate_content_config
+            ), tokens=estimate_tokens(contents))
+            return response.text
+
+        return await self.cache.cached_async(key, call, valid=valid)
+
     def transcribe_audio(self, audio_path: str) -> str:
         """Transcribe audio using Gemini model."""
         try:
-            with open(audio_path, "rb") as f:
-                response = self.client.models.generate_content(
-                    model=self.model,
-                    contents=[{"role": "user", "parts": [
-                        {"text": "Please provide an accurate transcript of this audio clip."},
-                        {"inline_data": {"mime_type": "audio/wav", "data": f.read()}}
-                    ]}], 
-                    config=self.generate_content_config
-                )
-            transcript = response.text.strip()
+            transcript = self.generate(self.transcription_contents(audio_path)).strip()
+            print(f"🗣️ Transcribed {os.path.basename(audio_path)}")
+            return transcript
+        except Exception as e:
+            print(f"⚠️ Transcription failed: {e}")
+            return ""
+
+    async def transcribe_audio_async(self, audio_path: str) -> str:
+        """transcribe_audio on the async client."""
+        try:
+            contents = await asyncio.to_thread(self.transcription_contents, audio_path)
+            transcript = (await self.generate_async(contents)).strip()
             print(f"🗣️ Transcribed {os.path.basename(audio_path)}")
             return transcript
         except Exception as e:
@@ -79,13 +116,17 @@ class VideoFrameAudioContextAnalyzer:
         return total
 
 
-    def analyze_multimodal_segment(self, frame_paths, audio_path, transcript_text, prompt):
-        """Send frames + audio + transcript to Gemini."""
+    def segment_parts(self, frame_paths, audio_path, transcript_text, prompt, face_overlay=None):
+        """Request parts for one segment: prompt + transcript, frames, audio."""
         # print(f"🎬 Analyzing {len(frame_paths)} frames + {os.path.basename(audio_path)} with transcript...")
         # print(frame_paths, audio_path)
-        parts = [
-            {"text": f"{prompt}\n\nHere is the transcript of the segment:\n{transcript_text}"}
-        ]
+        text = f"{prompt}\n\nHere is the transcript of the segment:\n{transcript_text}"
+        if face_overlay:
+            text += (
+                "\n\nDetected faces per frame, as frame number -> "
+                f"[[character, x1, y1, x2, y2], ...] in pixels:\n{face_overlay}"
+            )
+        parts = [{"text": text}]
         for frame_path in frame_paths:
             with open(frame_path, "rb") as f:
                 parts.append({"inline_data": {"mime_type": "image/jpeg", "data": f.read()}})
@@ -93,22 +134,39 @@ class VideoFrameAudioContextAnalyzer:
             parts.append({"inline_data": {"mime_type": "audio/wav", "data": f.read()}})
         
         print(f"📦 Payload size: {self.payload_size(parts) / (1024*1024):.2f} MB")
+        return parts
 
+    def analyze_multimodal_segment(self, frame_paths, audio_path, transcript_text, prompt, face_overlay=None):
+        """Send frames + audio + transcript to Gemini. face_overlay: face boxes text for unannotated frames."""
+        parts = self.segment_parts(frame_paths, audio_path, transcript_text, prompt, face_overlay)
         try:
-            response = self.client.models.generate_content(
-                model=self.model,
-                contents=[{"role": "user", "parts": parts}],
-                config=self.generate_content_config
-            )
-            return response.text
+            # replies that fail JSON extraction are not cached, so the retry really re-asks
+            return self.generate([{"role": "user", "parts": parts}], valid=is_json_response)
         except Exception as e:
             print(f"❌ Gemini analysis failed: {e}")
             return ""
 
-    def read_prompts(self, prompts_folder):
+    async def analyze_multimodal_segment_async(self, frame_paths, audio_path, transcript_text, prompt, face_overlay=None):
+        """analyze_multimodal_segment on the async client; files are read off the event loop."""
+        parts = await asyncio.to_thread(self.segment_parts, frame_paths, audio_path, transcript_text, prompt, face_overlay)
+        try:
+            return await self.generate_async([{"role": "user", "parts": parts}], valid=is_json_response)
+        except Exception as e:
+            print(f"❌ Gemini analysis failed: {e}")
+            return ""
+
+    def read_prompts(self, prompts_folder, annotated=True, overlay=False):
+        """Prompt templates filled in; {character_boxes} says where the face boxes are, if anywhere."""
         prompt_list = []
         prompt_files = sorted(glob.glob(os.path.join(prompts_folder, 'prompt*.txt')))
-        data = {"num_frames": self.chunk_size}
+        if annotated:
+            character_boxes = "Each image contains bounding box with the name of the Character."
+        elif overlay:
+            character_boxes = ("The images carry no bounding boxes; the Characters in each frame are listed "
+                               "after the transcript as bounding boxes in pixels, with their names.")
+        else:
+            character_boxes = ""
+        data = {"num_frames": self.chunk_size, "character_boxes": character_boxes}
         for file in prompt_files:
             print(file)
             with open(file, 'r') as f:
@@ -139,49 +197,48 @@ class VideoFrameAudioContextAnalyzer:
         return data
 
 
-def get_meta_data(args):
-    model = args["model"]
-    project = args["project"]
-    location = args["location"]
-    temperature = args["temperature"]
-    chunk_size = args["chunk_size"]
-    max_workers = args["max_workers"]
-    prompt_dir = args["prompt_dir"]
-    output = args["output_dir"]
+def face_overlay_text(frame_paths, overlay):
+    """Compact JSON of the faces.json boxes for one segment, keyed by 1-based frame number like the prompts."""
+    faces = {
+        str(n): overlay[os.path.basename(path)]
+        for n, path in enumerate(frame_paths, 1)
+        if os.path.basename(path) in overlay
+    }
+    return json.dumps(faces, separators=(",", ":")) if faces else None
 
-    audio_dir = os.path.join(output, "audio")
-    annotated_frames_dir = os.path.join(output, "annotated_frames")
-    
 
-    movie_name = os.path.basename(output)
+def chunk_path(output, movie_name, prompt_idx, chunk_idx):
+    return os.path.join(output, f"prompt{prompt_idx+1}", f"{movie_name}_chunk_{chunk_idx:03d}.json")
 
-    os.makedirs(output, exist_ok=True)
-    print(f"🗂️ Run output directory: {output}")
 
-    analyzer = VideoFrameAudioContextAnalyzer(project_id=project, location=location, model=model, temperature=temperature)
-    analyzer.chunk_size=chunk_size
-    print("🚀 Starting multi-prompt multimodal video analysis...\n")
+def save_chunk(path, data):
+    """Write a (prompt, chunk) result atomically, so a crash never leaves a truncated checkpoint."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+    print("💾 Saved", path)
 
 
-    audio_files = sorted(glob.glob(os.path.join(audio_dir, "*.wav")))
-    image_files = sorted(glob.glob(os.path.join(annotated_frames_dir, "*.jpg")))
-    segments = []
+def is_chunk_done(path):
+    """A checkpoint counts once it holds a non-empty JSON object; {} from a failed retry is redone."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            return bool(json.load(f))
+    except (OSError, ValueError):
+        return False
 
-    for i in range(len(audio_files)):
-        if (i+1) * chunk_size< len(image_files):
-            segments.append((image_files[i * chunk_size: (i+1) * chunk_size], audio_files[i]))
-        else:
-            segments.append((image_files[i * chunk_size: (i+1) * chunk_size], audio_files[i]))
 
-    prompt_files = analyzer.read_prompts(prompt_dir)
-    # prompt_files = sorted(glob.glob(os.path.join(prompt_dir, "prompt*.txt")))
-    # if not prompt_files:
-    #     print("❌ No prompt files found in folder.")
-    #     return
-    
-    # print("🎤 Transcribing all segments in parallel...", len(segments))
-    segments = segments[100:110]
-    print("🎤 Transcribing all segments in parallel...", len(segments))
+def run_segments_threaded(analyzer, segments, prompt_files, overlay, max_workers, pending, save):
+    """
+    Transcribe the segments that still have work, then run the prompts one
+    after another, each on its own thread pool with a serial retry of the
+    failed segments. Only (prompt, segment) pairs in `pending` are sent;
+    save(prompt, segment, json) is called as each one finishes.
+    """
+    todo = sorted({i for _, i in pending})
+    print("🎤 Transcribing all segments in parallel...", len(todo))
     def transcribe_segment(i, audio_path):
         transcript = analyzer.transcribe_audio(audio_path)   # single .aac
         return i, transcript
@@ -190,8 +247,8 @@ def get_meta_data(args):
 
     with ThreadPoolExecutor(max_workers=max_workers) as executor:
         futures = {
-            executor.submit(transcribe_segment, i, audio_path): i
-            for i, (_, audio_path) in enumerate(segments)
+            executor.submit(transcribe_segment, i, segments[i][1]): i
+            for i in todo
         }
 
         for future in as_completed(futures):
@@ -203,27 +260,26 @@ def get_meta_data(args):
                 print(f"⚠️ Transcription failed for segment {i}: {e}")
 
 
-        for i, prompt in enumerate(prompt_files):
-            # prompt_name = os.path.splitext(os.path.basename(prompt_path))[0]
-            print(f"\n🧩 Running prompt: prompt{i+1}")
-            output_dir = os.path.join(output, "prompt" + str(i+1))
-            os.makedirs(output_dir, exist_ok=True)
+        for p, prompt in enumerate(prompt_files):
+            chunks = [i for i in todo if (p, i) in pending]
+            if not chunks:
+                continue
+            print(f"\n🧩 Running prompt: prompt{p+1} ({len(chunks)} chunks)")
 
             def process_segment(i, frames, audio):
                 transcript = transcripts.get(i, "")
                 if not transcript:
                     return i, {}
-                json_text = analyzer.analyze_multimodal_segment(frames, audio, transcript, prompt)
+                json_text = analyzer.analyze_multimodal_segment(frames, audio, transcript, prompt, face_overlay_text(frames, overlay))
                 json_data = analyzer.extract_and_save_json(json_text)   # parse JSON only
                 return i, json_data
 
             with ThreadPoolExecutor(max_workers=max_workers) as executor:
                 futures = {
-                    executor.submit(process_segment, i, frames, audio): i
-                    for i, (frames, audio) in enumerate(segments, 0)
+                    executor.submit(process_segment, i, *segments[i]): i
+                    for i in chunks
                 }
 
-                results = {}
                 failed = []
                 for future in as_completed(futures):
                     i = futures[future]
@@ -232,7 +288,7 @@ def get_meta_data(args):
                         if not json_data:   # {} means Gemini returned invalid JSON
                             failed.append(i)
                         else:
-                            results[idx] = json_data
+                            save(p, idx, json_data)
                     except Exception as e:
                         print(f"⚠️ Segment {i} crashed: {e}")
                         failed.append(i)
@@ -243,20 +299,136 @@ def get_meta_data(args):
                     frames, audio = segments[i]
                     try:
                         transcript = transcripts.get(i, "")
-                        json_text = analyzer.analyze_multimodal_segment(frames, audio, transcript, prompt)
+                        json_text = analyzer.analyze_multimodal_segment(frames, audio, transcript, prompt, face_overlay_text(frames, overlay))
                         json_data = analyzer.extract_and_save_json(json_text)
-                        results[i] = json_data
+                        save(p, i, json_data)
                         print(f"✔ Retry success → segment {i}")
                     except Exception as e:
                         print(f"❌ Retry failed → segment {i}: {e}")
 
-            for idx in sorted(results.keys()):
-                out_path = os.path.join(output_dir, f"{movie_name}_chunk_{idx:03d}.json")
-                with open(out_path, "w", encoding="utf-8") as f:
-                    json.dump(results[idx], f, ensure_ascii=False, indent=2)
-                print("💾 Saved", out_path)
 
-    print("\n🏁 All prompts processed successfully.")
+async def run_segments_async(analyzer, segments, prompt_files, overlay, max_workers, pending, save, attempts=2, lookahead=None):
+    """
+    Every pending (prompt, segment) request through one scheduler of
+    max_workers concurrent Gemini calls. A segment's prompts are queued as
+    soon as its transcript is back, so there is no barrier between prompts
+    and a slow segment only holds up itself. save(prompt, segment, json) is
+    called as each request finishes.
+
+    At most `lookahead` segments (default max_workers) are open at a time,
+    from transcription until their last prompt is saved. Without that bound
+    every transcription would queue on the FIFO limit ahead of the first
+    prompt, and no chunk would be checkpointed until all audio was done.
+    """
+    limit = asyncio.Semaphore(max_workers)
+    window = asyncio.Semaphore(lookahead or max_workers)
+
+    async def analyze(i, p, frames, audio, transcript):
+        json_data = {}
+        for attempt in range(attempts):
+            try:
+                async with limit:
+                    json_text = await analyzer.analyze_multimodal_segment_async(
+                        frames, audio, transcript, prompt_files[p], face_overlay_text(frames, overlay)
+                    )
+                json_data = analyzer.extract_and_save_json(json_text)
+            except Exception as e:
+                print(f"⚠️ Segment {i} crashed on prompt{p+1}: {e}")
+                continue
+            if json_data:   # {} means Gemini returned invalid JSON
+                break
+            if attempt + 1 < attempts:
+                print(f"🔁 Retrying segment {i} on prompt{p+1}")
+        await asyncio.to_thread(save, p, i, json_data)
+
+    async def run_segment(i, frames, audio):
+        prompts = [p for p in range(len(prompt_files)) if (p, i) in pending]
+        async with window:
+            async with limit:
+                transcript = await analyzer.transcribe_audio_async(audio)
+            await asyncio.gather(*(analyze(i, p, frames, audio, transcript) for p in prompts))
+
+    todo = sorted({i for _, i in pending})
+    print(f"🎤 Running {len(pending)} (segment, prompt) requests over {len(todo)} segments, {max_workers} at a time...")
+    await asyncio.gather(*(run_segment(i, *segments[i]) for i in todo))
+
+
+def get_meta_data(args):
+    model = args["model"]
+    project = args["project"]
+    location = args["location"]
+    temperature = args["temperature"]
+    chunk_size = args["chunk_size"]
+    max_workers = args["max_workers"]
+    prompt_dir = args["prompt_dir"]
+    output = args["output_dir"]
+    annotated = args.get("annotated_frames", True)
+    engine = args.get("engine", "threads")   # "threads" or "async"
+
+    audio_dir = os.path.join(output, "audio")
+    # without annotated frames the boxes drawn on them go into the prompt as text
+    frames_dir = os.path.join(output, "annotated_frames" if annotated else "frames")
+    overlay = {}
+    overlay_path = os.path.join(output, "faces.json")
+    if not annotated and os.path.exists(overlay_path):
+        with open(overlay_path) as f:
+            overlay = json.load(f)
+
+    movie_name = os.path.basename(output)
+
+    os.makedirs(output, exist_ok=True)
+    print(f"🗂️ Run output directory: {output}")
+
+    analyzer = VideoFrameAudioContextAnalyzer(project_id=project, location=location, model=model, temperature=temperature)
+    analyzer.chunk_size=chunk_size
+    print("🚀 Starting multi-prompt multimodal video analysis...\n")
+
+
+    audio_files = sorted(glob.glob(os.path.join(audio_dir, "*.wav")))
+    image_files = sorted(glob.glob(os.path.join(frames_dir, "*.jpg")))
+    segments = []
+
+    for i in range(len(audio_files)):
+        if (i+1) * chunk_size< len(image_files):
+            segments.append((image_files[i * chunk_size: (i+1) * chunk_size], audio_files[i]))
+        else:
+            segments.append((image_files[i * chunk_size: (i+1) * chunk_size], audio_files[i]))
+
+    prompt_files = analyzer.read_prompts(prompt_dir, annotated=annotated, overlay=bool(overlay))
+    # prompt_files = sorted(glob.glob(os.path.join(prompt_dir, "prompt*.txt")))
+    # if not prompt_files:
+    #     print("❌ No prompt files found in folder.")
+    #     return
+    
+    # print("🎤 Transcribing all segments in parallel...", len(segments))
+    segments = segments[100:110]
+
+    # every (prompt, chunk) result is its own checkpoint; a rerun only sends the missing ones
+    pending = {
+        (p, i)
+        for p in range(len(prompt_files))
+        for i in range(len(segments))
+        if not is_chunk_done(chunk_path(output, movie_name, p, i))
+    }
+    total = len(prompt_files) * len(segments)
+    print(f"📌 {total - len(pending)}/{total} chunks already done, {len(pending)} to run")
+
+    def save(p, i, data):
+        save_chunk(chunk_path(output, movie_name, p, i), data)
+
+    if pending:
+        if engine == "async":
+            asyncio.run(run_segments_async(analyzer, segments, prompt_files, overlay, max_workers, pending, save))
+        else:
+            run_segments_threaded(analyzer, segments, prompt_files, overlay, max_workers, pending, save)
+
+    missing = sum(not is_chunk_done(chunk_path(output, movie_name, p, i)) for p, i in pending)
+    analyzer.cache.report()
+    if missing:
+        print(f"\n⚠️ {missing} chunks still without a valid result, a rerun retries only those.")
+    else:
+        print("\n🏁 All prompts processed successfully.")
+    return missing
 
 
 if __name__ == "__main__":
@@ -1,54 +1,347 @@
-
+import os
+import select
+import signal
+import socket
+import threading
+from contextlib import contextmanager
 from config import PIPELINE_TABLE as table
+from config import LEASE_DURATION, HEARTBEAT_INTERVAL
+from config import MAX_ATTEMPTS, RETRY_BASE_DELAY, RETRY_MAX_DELAY, JOB_BATCH_SIZE
+
+_listening = set()
+
+def worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def lease_lost(job_id):
+    print(f"⚠️ Lost lease on job {job_id}, leaving it to its new owner")
+    return False
+
+def stage_channel(stage):
+    return f"{table}_{stage}"
+
+def notify_stage(cur, stage):
+    """Wake workers listening on a stage; delivered when the caller commits."""
+    cur.execute("SELECT pg_notify(%s, '')", (stage_channel(stage),))
+
+def wait_for_job(conn, stage, timeout):
+    """
+    Block until a NOTIFY arrives for the stage or timeout seconds pass.
+    Returns True if woken by a notification, False on timeout.
+    """
+    channel = stage_channel(stage)
+    if (id(conn), channel) not in _listening:
+        with conn.cursor() as cur:
+            cur.execute(f'LISTEN "{channel}"')
+        conn.commit()
+        _listening.add((id(conn), channel))
+        # work may have arrived before we subscribed, so let the caller look again
+        return True
+
+    conn.poll()
+    if not conn.notifies:
+        if select.select([conn], [], [], timeout) == ([], [], []):
+            return False
+        conn.poll()
+    woken = bool(conn.notifies)
+    conn.notifies.clear()
+    return woken
+
+def fetch_next_jobs(conn, stage, n, status='pending', lease_duration=LEASE_DURATION):
+    """
+    Claim up to n jobs of a stage in one statement and return them as a list.
+    Claimed rows are leased to this worker; rows whose lease has expired are
+    claimable again (as are in_progress rows with no lease at all, left over
+    from before leases), rows under a live lease are never handed out twice.
+    Rows still backing off from a retry are skipped. Claiming does not count
+    as an attempt, start_job does, so rows that expire while queued behind a
+    batch-mate are never charged for a run they did not get.
+    """
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            UPDATE {table}
+            SET status = 'in_progress', updated_at = NOW(),
+                lease_owner = %s, lease_expires_at = NOW() + %s * INTERVAL '1 second'
+            WHERE id IN (
+                SELECT id FROM {table}
+                WHERE stage = %s
+                  AND (status = %s OR (status = 'in_progress' AND (lease_expires_at IS NULL OR lease_expires_at < NOW())))
+                  AND (lease_expires_at IS NULL OR lease_expires_at < NOW())
+                  AND (not_before IS NULL OR not_before <= NOW())
+                ORDER BY priority DESC, updated_at DESC
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING *
+        """, (worker_id(), lease_duration, stage, status, n))
+        jobs = cur.fetchall()
+        conn.commit()
+    # RETURNING does not preserve the subquery order
+    jobs.sort(key=lambda job: job['priority'], reverse=True)
+
+    # a job that keeps killing its worker comes back through lease expiry, not retry_job
+    runnable = []
+    for job in jobs:
+        if job['attempts'] >= max_attempts(stage):
+            mark_job_failed(conn, job['id'], error=f"gave up after {job['attempts']} attempts: {job['last_error']}")
+        else:
+            runnable.append(job)
+    return runnable
+
+def max_attempts(stage):
+    return MAX_ATTEMPTS.get(stage, MAX_ATTEMPTS['default'])
+
+def batch_size(stage):
+    return JOB_BATCH_SIZE.get(stage, JOB_BATCH_SIZE['default'])
 
 def fetch_next_job(conn, stage, status='pending'):
+    jobs = fetch_next_jobs(conn, stage, 1, status=status)
+    return jobs[0] if jobs else None
+
+def heartbeat_jobs(conn, job_ids, lease_duration=LEASE_DURATION):
+    """Extend this worker's lease on several jobs in one statement. Returns the ids still owned."""
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            UPDATE {table}
+            SET lease_expires_at = NOW() + %s * INTERVAL '1 second'
+            WHERE id = ANY(%s) AND status = 'in_progress' AND lease_owner = %s
+            RETURNING id
+        """, (lease_duration, list(job_ids), worker_id()))
+        owned = {row['id'] for row in cur.fetchall()}
+        conn.commit()
+    return owned
+
+def heartbeat(conn, job_id, lease_duration=LEASE_DURATION):
+    """Extend this worker's lease on a job. Returns False if the lease was lost."""
+    return job_id in heartbeat_jobs(conn, [job_id], lease_duration)
+
+def start_job(conn, job, lease_duration=LEASE_DURATION):
+    """
+    Heartbeat a claimed job right before working on it and count the attempt.
+    Updates job['attempts'] and returns False if the lease was lost.
+    """
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            UPDATE {table}
+            SET attempts = attempts + 1, lease_expires_at = NOW() + %s * INTERVAL '1 second'
+            WHERE id = %s AND status = 'in_progress' AND lease_owner = %s
+            RETURNING attempts
+        """, (lease_duration, job['id'], worker_id()))
+        row = cur.fetchone()
+        conn.commit()
+    if row is None:
+        return False
+    job['attempts'] = row['attempts']
+    return True
+
+@contextmanager
+def keep_lease_alive(job_ids, interval=HEARTBEAT_INTERVAL):
+    """
+    Heartbeat a set of job ids from a background thread while the body runs.
+    The set is read on every beat, so a batch can be held as a whole and each
+    job discarded from it once finished; ids whose lease was lost are dropped.
+    The thread uses its own connection, so its commits and errors never touch
+    a transaction the stage has open; it reconnects after a failed beat.
+    """
+    from utils.aud_db_utils import get_pg_conn
+    stop = threading.Event()
+
+    def beat():
+        conn = None
+        while not stop.wait(interval):
+            ids = set(job_ids)
+            if not ids:
+                continue
+            try:
+                if conn is None:
+                    conn = get_pg_conn()
+                for job_id in ids - heartbeat_jobs(conn, ids):
+                    print(f"⚠️ Lost lease on job {job_id}")
+                    job_ids.discard(job_id)
+            except Exception as e:
+                print(f"⚠️ Heartbeat failed for jobs {sorted(ids)}: {e}")
+                conn = close_quietly(conn)
+        close_quietly(conn)
+
+    thread = threading.Thread(target=beat, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+def close_quietly(conn):
+    """Close a connection that may already be broken. Returns None, for `conn = close_quietly(conn)`."""
+    if conn is not None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+    return None
+
+def reclaim_expired_jobs(conn):
+    """
+    Return in_progress jobs whose lease expired to pending. Returns the count.
+    An in_progress row without a lease predates leases and counts as expired.
+    """
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            UPDATE {table}
+            SET status = 'pending', updated_at = NOW(),
+                lease_owner = NULL, lease_expires_at = NULL
+            WHERE status = 'in_progress' AND (lease_expires_at IS NULL OR lease_expires_at < NOW())
+            RETURNING stage
+        """)
+        rows = cur.fetchall()
+        for stage in {row['stage'] for row in rows}:
+            notify_stage(cur, stage)
+        conn.commit()
+    return len(rows)
+
+def retry_job(conn, job, error):
+    """
+    Put a failed job back to pending behind an exponential backoff, or mark
+    it failed once the stage's attempt limit is reached.
+    Returns True if the job was scheduled for another attempt, False if it
+    was failed or this worker no longer holds its lease.
+    """
+    attempts = job['attempts']
+    if attempts >= max_attempts(job['stage']):
+        mark_job_failed(conn, job['id'], error=error)
+        return False
+
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempts - 1))
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            UPDATE {table}
+            SET status = 'pending', updated_at = NOW(), last_error = %s,
+                not_before = NOW() + %s * INTERVAL '1 second',
+                lease_owner = NULL, lease_expires_at = NULL
+            WHERE id = %s AND lease_owner = %s
+        """, (str(error), delay, job['id'], worker_id()))
+        owned = cur.rowcount == 1
+        conn.commit()
+    if not owned:
+        return lease_lost(job['id'])
+    print(f"🔁 Job {job['id']} attempt {attempts} failed, retrying in {delay}s: {error}")
+    return True
+
+class StopRequested(BaseException):
+    """Raised in a stage loop by SIGTERM / SIGINT; a BaseException so per-job `except Exception` does not swallow it."""
+
+def stop_on_signals():
+    """
+    Turn the first SIGTERM or SIGINT into StopRequested in the main thread.
+    Default handling is restored first, so a second signal still kills the
+    worker if releasing its jobs hangs.
+    """
+    def handler(signum, frame):
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        raise StopRequested(signal.Signals(signum).name)
+
+    signal.signal(signal.SIGTERM, handler)
+    signal.signal(signal.SIGINT, handler)
+
+def release_jobs(conn, job_ids, started=None):
+    """
+    Hand jobs this worker still holds back to pending for other workers,
+    e.g. on shutdown. The attempt counted for the interrupted job `started`
+    is refunded, since it did not fail on its own. Returns the count.
+    """
+    if not job_ids:
+        return 0
+    # the signal may have interrupted a statement, leaving the transaction aborted
+    conn.rollback()
     with conn.cursor() as cur:
         cur.execute(f"""
-            SELECT * FROM {table}
-            WHERE stage = %s AND status = %s
-            ORDER BY priority DESC, updated_at DESC
-            LIMIT 1
-            FOR UPDATE SKIP LOCKED
-        """, (stage, status))
-        job = cur.fetchone()
-        if job:
-            cur.execute(f"""
-                UPDATE {table}
-                SET status = 'in_progress', updated_at = NOW()
-                WHERE id = %s
-            """, (job['id'],))
-            conn.commit()
-        return job
-
-def update_job_stage(conn, job_id, new_stage, new_status='pending', addons=[]):
+            UPDATE {table}
+            SET status = 'pending', updated_at = NOW(),
+                attempts = GREATEST(attempts - CASE WHEN id = %s THEN 1 ELSE 0 END, 0),
+                lease_owner = NULL, lease_expires_at = NULL
+            WHERE id = ANY(%s) AND status = 'in_progress' AND lease_owner = %s
+            RETURNING stage
+        """, (started, list(job_ids), worker_id()))
+        rows = cur.fetchall()
+        for stage in {row['stage'] for row in rows}:
+            notify_stage(cur, stage)
+        conn.commit()
+    return len(rows)
+
+def get_stage_counts(conn):
+    """Runnable pending and in_progress job counts per stage."""
+    counts = {}
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            SELECT stage,
+                   COUNT(*) FILTER (WHERE status = 'pending' AND (not_before IS NULL OR not_before <= NOW())) AS pending,
+                   COUNT(*) FILTER (WHERE status = 'in_progress') AS in_progress
+            FROM {table}
+            GROUP BY stage
+        """)
+        for row in cur.fetchall():
+            counts[row['stage']] = {'pending': row['pending'], 'in_progress': row['in_progress']}
+        conn.commit()
+    return counts
+
+def get_lease_owners(conn):
+    """Workers currently holding a live lease, as worker_id() strings."""
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            SELECT DISTINCT lease_owner FROM {table}
+            WHERE status = 'in_progress' AND lease_expires_at >= NOW()
+        """)
+        owners = {row['lease_owner'] for row in cur.fetchall()}
+        conn.commit()
+    return owners
+
+# The writes below only apply while this worker still holds the job's lease,
+# so a worker that stalled past its lease cannot clobber the new owner's run.
+# Each returns False (and changes nothing) once the lease is lost.
+
+def update_job_stage(conn, job_id, new_stage, new_status='pending', addons=[], error=None):
+    """Move a job on to new_stage; error, if given, is kept in last_error as a note on the result."""
     addon_conditions = ', '.join(addons)
     with conn.cursor() as cur:
         cur.execute(f"""
             UPDATE {table}
-            SET stage = %s, status = %s, updated_at = NOW() {', ' + addon_conditions if addons else ''}
-            WHERE id = %s
-        """, (new_stage, new_status, job_id))
+            SET stage = %s, status = %s, updated_at = NOW(),
+                attempts = 0, last_error = %s, not_before = NULL,
+                lease_owner = NULL, lease_expires_at = NULL {', ' + addon_conditions if addons else ''}
+            WHERE id = %s AND lease_owner = %s
+        """, (new_stage, new_status, None if error is None else str(error), job_id, worker_id()))
+        owned = cur.rowcount == 1
+        if owned and new_status == 'pending':
+            notify_stage(cur, new_stage)
         conn.commit()
+    return owned or lease_lost(job_id)
 
 def mark_job_done(conn, job_id, addons=[]):
     addon_conditions = ', '.join(addons)
     with conn.cursor() as cur:
         cur.execute(f"""
             UPDATE {table}
-            SET status = 'done', updated_at = NOW() {', ' + addon_conditions if addons else ''}
-            WHERE id = %s
-        """, (job_id,))
+            SET status = 'done', updated_at = NOW(),
+                lease_owner = NULL, lease_expires_at = NULL {', ' + addon_conditions if addons else ''}
+            WHERE id = %s AND lease_owner = %s
+        """, (job_id, worker_id()))
+        owned = cur.rowcount == 1
         conn.commit()
+    return owned or lease_lost(job_id)
 
-def mark_job_failed(conn, job_id, addons=[]):
+def mark_job_failed(conn, job_id, addons=[], error=None):
     addon_conditions = ', '.join(addons)
     with conn.cursor() as cur:
         cur.execute(f"""
             UPDATE {table}
-            SET status = 'failed', updated_at = NOW() {', ' + addon_conditions if addons else ''}
-            WHERE id = %s
-        """, (job_id,))
+            SET status = 'failed', updated_at = NOW(), last_error = COALESCE(%s, last_error),
+                lease_owner = NULL, lease_expires_at = NULL {', ' + addon_conditions if addons else ''}
+            WHERE id = %s AND lease_owner = %s
+        """, (None if error is None else str(error), job_id, worker_id()))
+        owned = cur.rowcount == 1
         conn.commit()
+    return owned or lease_lost(job_id)
 
 def update_job_priority(conn, job_id, new_priority):
     with conn.cursor() as cur:
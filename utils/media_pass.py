@@ -0,0 +1,95 @@
+import os
+import math
+import time
+import threading
+
+import cv2
+from scenedetect.detectors import ContentDetector
+from scenedetect.scene_manager import compute_downscale_factor
+
+from utils.video_utils import ensure_dir, probe_duration, split_audio
+from utils.detect_shots import scenes_from_cuts, save_shots
+
+
+def analyze_media(video_path, out_dir, split_duration=5, resize_w=640, threshold=30.0, downscale=None, frame_skip=0, clip_workers=4, write_clips=True):
+    """
+    One pass over a title that produces everything download_stage needs:
+    audio/ chunks, 1 fps frames/ and shots.json + shots/.
+
+    The video is decoded once and every frame goes to ContentDetector, while
+    the frame at int(sec * fps) is also written to frames/. The audio track is
+    demuxed and chunked by a second ffmpeg reader running alongside, so no
+    stream is decoded twice.
+
+    downscale / frame_skip behave like detect_shots_fast: None keeps
+    SceneManager's auto-downscale, and skipped frames are only grabbed, not
+    decoded, unless they are 1 fps samples.
+    """
+    total_start = time.time()
+    video_name = os.path.splitext(os.path.basename(video_path))[0]
+    base_dir = os.path.join(out_dir, video_name)
+    frames_dir = os.path.join(base_dir, "frames")
+    audio_dir = os.path.join(base_dir, "audio")
+    ensure_dir(frames_dir)
+    ensure_dir(audio_dir)
+
+    duration = probe_duration(video_path)
+    num_chunks = math.ceil(duration / split_duration)
+    num_seconds = num_chunks * split_duration
+    print(f"Total duration: {duration:.2f}s | Chunks: {num_chunks}")
+
+    audio_thread = threading.Thread(
+        target=split_audio,
+        args=(video_path, audio_dir, video_name),
+        kwargs={"split_duration": split_duration, "num_chunks": num_chunks},
+    )
+    audio_thread.start()
+
+    cap = cv2.VideoCapture(video_path)
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    frame_w = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    frame_h = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    if downscale is None:
+        # same auto-downscale SceneManager applies before running detectors
+        downscale = compute_downscale_factor(frame_w)
+    small_size = (round(frame_w / downscale), round(frame_h / downscale))
+
+    detector = ContentDetector(threshold=threshold)
+    cuts = []
+    frame_num = 0
+    sec = 0
+    next_sample = 0
+    while True:
+        if frame_skip and frame_num % (frame_skip + 1) and not (sec < num_seconds and next_sample == frame_num):
+            if not cap.grab():
+                break
+            frame_num += 1
+            continue
+
+        ok, frame = cap.read()
+        if not ok:
+            break
+
+        while sec < num_seconds and next_sample == frame_num:
+            new_h = int(frame_h * (resize_w / frame_w))
+            resized_frame = cv2.resize(frame, (resize_w, new_h), interpolation=cv2.INTER_LINEAR)
+            cv2.imwrite(os.path.join(frames_dir, f"{sec + 1:08d}.jpg"), resized_frame)
+            sec += 1
+            next_sample = int(sec * fps)
+
+        small = frame if downscale <= 1 else cv2.resize(frame, small_size, interpolation=cv2.INTER_LINEAR)
+        cuts.extend(detector.process_frame(frame_num, small))
+        frame_num += 1
+
+    cuts.extend(detector.post_process(frame_num))
+    cap.release()
+    detect_time = time.time() - total_start
+    print(f"✔ {sec} frames written, {len(cuts)} cuts detected over {frame_num} frames")
+
+    audio_thread.join()
+
+    scene_list = scenes_from_cuts(cuts, frame_num, fps)
+    save_shots(video_path, scene_list, detect_time=detect_time, total_start=total_start,
+               clip_workers=clip_workers, write_clips=write_clips)
+    print("\n🎉 Finished!")
+    return scene_list
@@ -0,0 +1,253 @@
+import io
+import time
+import wave
+import random
+import asyncio
+import threading
+
+from config import GEMINI_RPM, GEMINI_TPM, GEMINI_MAX_CONCURRENCY, GEMINI_MAX_RETRIES
+from config import GEMINI_BACKOFF_BASE, GEMINI_BACKOFF_MAX, GEMINI_SHARED_LIMITS, RATE_LIMIT_TABLE
+
+IMAGE_TOKENS = 258  # Gemini bills each image up to 384px as 258 tokens
+AUDIO_TOKENS_PER_SECOND = 32
+
+
+def estimate_tokens(contents):
+    """Rough input token count of a generate_content payload (str or list of parts / turns)."""
+    if isinstance(contents, str):
+        return max(1, len(contents) // 4)
+
+    total = 0
+    for item in contents:
+        if isinstance(item, dict) and "parts" in item:
+            total += estimate_tokens(item["parts"])
+        elif isinstance(item, dict) and "text" in item:
+            total += len(item["text"]) // 4
+        elif isinstance(item, dict) and "inline_data" in item:
+            blob = item["inline_data"]
+            if blob["mime_type"].startswith("image/"):
+                total += IMAGE_TOKENS
+            elif blob["mime_type"] == "audio/wav":
+                with wave.open(io.BytesIO(blob["data"])) as wf:
+                    total += int(wf.getnframes() / wf.getframerate() * AUDIO_TOKENS_PER_SECOND)
+    return max(1, total)
+
+
+def is_rate_limited(error):
+    return getattr(error, "code", None) == 429 or "429" in str(error) or "RESOURCE_EXHAUSTED" in str(error)
+
+
+def is_retryable(error):
+    """429s plus the transient server-side failures Vertex returns under load."""
+    return is_rate_limited(error) or getattr(error, "code", None) in (500, 502, 503, 504) or "UNAVAILABLE" in str(error)
+
+
+def backoff_delay(attempt, base=GEMINI_BACKOFF_BASE, cap=GEMINI_BACKOFF_MAX):
+    """Full-jitter exponential backoff, so throttled workers do not retry in lockstep."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class TokenBucket:
+    """
+    Per-minute budget refilled continuously. reserve() always takes the
+    tokens and returns how long the caller has to wait before using them,
+    so concurrent callers queue up in order instead of spinning.
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.tokens = float(per_minute)
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, n=1):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate) - n
+            self.updated_at = now
+            return max(0.0, -self.tokens / self.rate)
+
+
+class SharedTokenBucket:
+    """
+    TokenBucket kept in a Postgres row, so every inference and shot
+    description process on every host draws from the same project quota.
+    While Postgres is unreachable it falls back to an in-process TokenBucket,
+    and tries a fresh connection from connect() every retry_after seconds.
+    """
+
+    def __init__(self, connect, name, per_minute, retry_after=30.0):
+        self.connect = connect
+        self.conn = None
+        self.name = name
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.local = TokenBucket(per_minute)
+        self.retry_after = retry_after
+        self.retry_at = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self, n=1):
+        with self._lock:
+            if self.conn is None and time.monotonic() < self.retry_at:
+                return self.local.reserve(n)
+            try:
+                if self.conn is None:
+                    self.conn = self.connect()
+                return self._reserve_shared(n)
+            except Exception as e:
+                # an aborted transaction would fail every later statement, so drop the connection
+                print(f"⚠️ Shared Gemini budget {self.name} unavailable, using the in-process bucket: {e}")
+                if self.conn is not None:
+                    try:
+                        self.conn.close()
+                    except Exception:
+                        pass
+                self.conn = None
+                self.retry_at = time.monotonic() + self.retry_after
+                return self.local.reserve(n)
+
+    def _reserve_shared(self, n):
+        with self.conn.cursor() as cur:
+            cur.execute(f"""
+                INSERT INTO {RATE_LIMIT_TABLE} (name, tokens, updated_at)
+                VALUES (%(name)s, %(capacity)s, clock_timestamp())
+                ON CONFLICT (name) DO NOTHING
+            """, {"name": self.name, "capacity": self.capacity})
+            cur.execute(f"""
+                UPDATE {RATE_LIMIT_TABLE}
+                SET tokens = LEAST(%(capacity)s, tokens + EXTRACT(EPOCH FROM clock_timestamp() - updated_at) * %(rate)s) - %(n)s,
+                    updated_at = clock_timestamp()
+                WHERE name = %(name)s
+                RETURNING tokens
+            """, {"name": self.name, "capacity": self.capacity, "rate": self.rate, "n": n})
+            tokens = cur.fetchone()["tokens"]
+            self.conn.commit()
+        return max(0.0, -tokens / self.rate)
+
+
+class AdaptiveConcurrency:
+    """
+    AIMD limit on requests in flight: +1 after every `limit` successes,
+    halved on a 429, never below min_limit or above max_limit. The 429s of
+    one burst arrive together, so the limit is halved at most once per
+    `cooldown` seconds.
+    """
+
+    def __init__(self, max_limit, min_limit=1, cooldown=1.0):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.cooldown = cooldown
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self.successes = 0
+        self.last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def try_acquire(self):
+        with self._cond:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return True
+            return False
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    async def acquire_async(self):
+        while not self.try_acquire():
+            await asyncio.sleep(0.05)
+
+    def release(self, throttled=False):
+        with self._cond:
+            self.in_flight -= 1
+            if throttled:
+                self.successes = 0
+                if time.monotonic() - self.last_decrease >= self.cooldown:
+                    self.last_decrease = time.monotonic()
+                    self.limit = max(self.min_limit, self.limit / 2)
+                    print(f"🐢 Gemini throttled, concurrency limit -> {int(self.limit)}")
+            else:
+                self.successes += 1
+                if self.successes >= self.limit and self.limit < self.max_limit:
+                    self.limit += 1
+                    self.successes = 0
+            self._cond.notify_all()
+
+
+class GeminiLimiter:
+    """
+    Client-side limits for Vertex calls: requests-per-minute and
+    tokens-per-minute buckets, AIMD concurrency, and jittered exponential
+    backoff on 429 / transient errors. call() and call_async() raise the
+    last error once max_retries is used up.
+    """
+
+    def __init__(self, rpm, tpm, max_concurrency, max_retries=5, connect=None):
+        if connect is not None:
+            self.requests = SharedTokenBucket(connect, "gemini_requests", rpm)
+            self.tokens = SharedTokenBucket(connect, "gemini_tokens", tpm)
+        else:
+            self.requests = TokenBucket(rpm)
+            self.tokens = TokenBucket(tpm)
+        self.concurrency = AdaptiveConcurrency(max_concurrency)
+        self.max_retries = max_retries
+
+    def _reserve(self, tokens):
+        return max(self.requests.reserve(1), self.tokens.reserve(tokens))
+
+    def call(self, fn, tokens=1):
+        for attempt in range(self.max_retries + 1):
+            time.sleep(self._reserve(tokens))
+            self.concurrency.acquire()
+            try:
+                result = fn()
+            except Exception as e:
+                self.concurrency.release(throttled=is_rate_limited(e))
+                if not is_retryable(e) or attempt == self.max_retries:
+                    raise
+                delay = backoff_delay(attempt)
+                print(f"🔁 Gemini call failed ({e}), retry {attempt + 1}/{self.max_retries} in {delay:.1f}s")
+                time.sleep(delay)
+            else:
+                self.concurrency.release()
+                return result
+
+    async def call_async(self, fn, tokens=1):
+        """fn returns a fresh awaitable on every call."""
+        for attempt in range(self.max_retries + 1):
+            await asyncio.sleep(await asyncio.to_thread(self._reserve, tokens))
+            await self.concurrency.acquire_async()
+            try:
+                result = await fn()
+            except Exception as e:
+                self.concurrency.release(throttled=is_rate_limited(e))
+                if not is_retryable(e) or attempt == self.max_retries:
+                    raise
+                delay = backoff_delay(attempt)
+                print(f"🔁 Gemini call failed ({e}), retry {attempt + 1}/{self.max_retries} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+            else:
+                self.concurrency.release()
+                return result
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_limiter():
+    """The process-wide GeminiLimiter, sharing its budget through Postgres when GEMINI_SHARED_LIMITS is on."""
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            connect = None
+            if GEMINI_SHARED_LIMITS:
+                from utils.aud_db_utils import get_pg_conn
+                connect = get_pg_conn
+            _limiter = GeminiLimiter(GEMINI_RPM, GEMINI_TPM, GEMINI_MAX_CONCURRENCY, GEMINI_MAX_RETRIES, connect=connect)
+        return _limiter
@@ -0,0 +1,180 @@
+import os
+import json
+import time
+import asyncio
+import sqlite3
+import hashlib
+import threading
+
+from config import GEMINI_CACHE, GEMINI_CACHE_PATH, GEMINI_CACHE_MAX_MB
+
+
+def _feed(h, value):
+    """Hash nested contents unambiguously: every value is tagged with its type and length."""
+    if isinstance(value, bytes):
+        h.update(b"b%d:" % len(value))
+        h.update(value)
+    elif isinstance(value, str):
+        _feed(h, value.encode("utf-8"))
+    elif isinstance(value, dict):
+        h.update(b"d%d:" % len(value))
+        for k in sorted(value):
+            _feed(h, k)
+            _feed(h, value[k])
+    elif isinstance(value, (list, tuple)):
+        h.update(b"l%d:" % len(value))
+        for item in value:
+            _feed(h, item)
+    else:
+        _feed(h, repr(value))
+
+
+def request_key(model, config, contents):
+    """sha256 over model, generation config, prompt text and every input byte."""
+    h = hashlib.sha256()
+    _feed(h, model)
+    _feed(h, config.model_dump_json(exclude_none=True) if hasattr(config, "model_dump_json") else config)
+    _feed(h, contents)
+    return h.hexdigest()
+
+
+def is_json_response(text):
+    """
+    True when extract_and_save_json would get a non-empty object out of text.
+    An empty reply is treated as a failure downstream, so caching one would
+    make that chunk fail the same way on every retry.
+    """
+    start, end = text.find('{'), text.rfind('}')
+    if start == -1 or end == -1:
+        return False
+    try:
+        return bool(json.loads(text[start:end+1]))
+    except Exception:
+        return False
+
+
+class ResponseCache:
+    """
+    Gemini response texts in SQLite, keyed by request_key. Shared by every
+    process on the host (WAL mode); once the stored texts pass max_mb the
+    least recently used ones are evicted down to 90% of it. Their total size
+    is kept as a running sum in the meta table, updated in the same
+    transaction as each insert, so a put never scans the table.
+    """
+
+    def __init__(self, path, max_mb=2048):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.max_bytes = max_mb * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # autocommit; put() opens its own write transaction
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                text TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+        """)
+        self.db.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        # seeded once, for a cache file written before the running total was kept
+        self.db.execute("INSERT OR IGNORE INTO meta (name, value) SELECT 'total_size', COALESCE(SUM(size), 0) FROM responses")
+
+    def get(self, key):
+        with self._lock:
+            row = self.db.execute("SELECT text FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.db.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def put(self, key, text):
+        size = len(text.encode("utf-8"))
+        with self._lock:
+            # IMMEDIATE takes the write lock up front, so other processes cannot interleave with the running total
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+                self.db.execute(
+                    "INSERT OR REPLACE INTO responses (key, text, size, accessed_at) VALUES (?, ?, ?, ?)",
+                    (key, text, size, time.time())
+                )
+                total = self._add_size(size - (row[0] if row else 0))
+                if total > self.max_bytes:
+                    self._add_size(-self._evict(total - int(self.max_bytes * 0.9)))
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def _add_size(self, delta):
+        self.db.execute("UPDATE meta SET value = value + ? WHERE name = 'total_size'", (delta,))
+        return self.db.execute("SELECT value FROM meta WHERE name = 'total_size'").fetchone()[0]
+
+    def _evict(self, to_free):
+        freed = 0
+        evicted = []
+        for key, size in self.db.execute("SELECT key, size FROM responses ORDER BY accessed_at"):
+            if freed >= to_free:
+                break
+            evicted.append((key,))
+            freed += size
+        self.db.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        print(f"🧹 Gemini cache evicted {len(evicted)} responses ({freed / 2**20:.1f} MB)")
+        return freed
+
+    def cached(self, key, fn, valid=bool):
+        """Cached text for key, else fn() -> text, stored when valid(text)."""
+        text = self.get(key)
+        if text is None:
+            text = fn()
+            if text and valid(text):
+                self.put(key, text)
+        return text
+
+    async def cached_async(self, key, fn, valid=bool):
+        """cached() for an async fn; SQLite is only touched off the event loop."""
+        text = await asyncio.to_thread(self.get, key)
+        if text is None:
+            text = await fn()
+            if text and valid(text):
+                await asyncio.to_thread(self.put, key, text)
+        return text
+
+    def report(self):
+        total = self.hits + self.misses
+        rate = self.hits / total * 100 if total else 0.0
+        print(f"   🔹 Gemini cache: {self.hits} hits, {self.misses} misses ({rate:.1f}% hit rate)")
+
+
+class NoCache:
+    """Stand-in when GEMINI_CACHE is off."""
+
+    def cached(self, key, fn, valid=bool):
+        return fn()
+
+    async def cached_async(self, key, fn, valid=bool):
+        return await fn()
+
+    def report(self):
+        pass
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """The process-wide response cache at GEMINI_CACHE_PATH."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache(GEMINI_CACHE_PATH, GEMINI_CACHE_MAX_MB) if GEMINI_CACHE else NoCache()
+        return _cache
@@ -1,13 +1,133 @@
 import os
 import cv2
+import wave
 import subprocess
 import math
+from concurrent.futures import ProcessPoolExecutor
 
 
 def ensure_dir(path):
     os.makedirs(path, exist_ok=True)
 
-def split_video(video_path, out_dir, split_duration=5, resize_w=640):
+
+def probe_duration(video_path):
+    return float(subprocess.check_output([
+        "ffprobe", "-v", "error", "-show_entries", "format=duration",
+        "-of", "default=noprint_wrappers=1:nokey=1", video_path
+    ]).decode().strip())
+
+
+def probe_audio(video_path):
+    """Sample rate and channel count of the first audio stream, None if there is none."""
+    out = subprocess.check_output([
+        "ffprobe", "-v", "error", "-select_streams", "a:0",
+        "-show_entries", "stream=sample_rate,channels",
+        "-of", "default=noprint_wrappers=1", video_path
+    ]).decode()
+    info = dict(line.split("=", 1) for line in out.split())
+    if "sample_rate" not in info:
+        return None
+    return int(info["sample_rate"]), int(info["channels"])
+
+
+def split_audio(video_path, audio_dir, video_name, split_duration=5, num_chunks=None):
+    """
+    Decode the audio track once and cut it into <video_name>_chunk_NNNN.wav
+    files of split_duration seconds, sample-exact, in a single ffmpeg run.
+    """
+    stream = probe_audio(video_path)
+    if stream is None:
+        print(f"⚠️ No audio stream in {video_path}")
+        return 0
+    sample_rate, channels = stream
+    sample_width = 2  # pcm_s16le
+    chunk_bytes = split_duration * sample_rate * channels * sample_width
+
+    proc = subprocess.Popen([
+        "ffmpeg", "-v", "error", "-nostdin",
+        "-i", video_path, "-vn",
+        "-acodec", "pcm_s16le", "-ar", str(sample_rate), "-ac", str(channels),
+        "-f", "s16le", "pipe:1"
+    ], stdout=subprocess.PIPE)
+
+    i = 0
+    try:
+        while num_chunks is None or i < num_chunks:
+            data = proc.stdout.read(chunk_bytes)
+            if not data:
+                break
+            chunk_audio = os.path.join(audio_dir, f"{video_name}_chunk_{i:04d}.wav")
+            with wave.open(chunk_audio, "wb") as wf:
+                wf.setnchannels(channels)
+                wf.setsampwidth(sample_width)
+                wf.setframerate(sample_rate)
+                wf.writeframes(data)
+            i += 1
+    finally:
+        proc.stdout.close()
+        proc.kill()
+        proc.wait()
+
+    print(f"✔ {i} audio chunks written to {audio_dir}")
+    return i
+
+def _sample_range(video_path, frames_dir, sec_start, sec_end, resize_w=640):
+    """
+    Write the frame at int(sec * fps) for every second in [sec_start, sec_end)
+    as frames/<sec+1>.jpg. Seeks at most once, then decodes forward with
+    grab() and only retrieves the frames that are kept.
+    """
+    cap = cv2.VideoCapture(video_path)
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    pos = int(sec_start * fps)
+    if pos > 0:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, pos)
+
+    written = 0
+    frame = None
+    for sec in range(sec_start, sec_end):
+        frame_index = int(sec * fps)
+        if frame_index >= pos or frame is None:
+            ok = True
+            while pos < frame_index and ok:
+                ok = cap.grab()
+                pos += 1
+            ok, frame = cap.read() if ok else (False, None)
+            pos += 1
+            if not ok:
+                break
+        # with fps < 1 the same frame is sampled again, like the old per-second seek
+
+        h, w = frame.shape[:2]
+        new_h = int(h * (resize_w / w))
+        resized_frame = cv2.resize(frame, (resize_w, new_h), interpolation=cv2.INTER_LINEAR)
+        cv2.imwrite(os.path.join(frames_dir, f"{sec + 1:08d}.jpg"), resized_frame)
+        written += 1
+
+    cap.release()
+    return written
+
+
+def sample_frames(video_path, frames_dir, num_seconds, resize_w=640, workers=1):
+    """
+    Sample one frame per second with a single linear decode of the title.
+    With workers > 1 the timeline is split into contiguous ranges decoded in
+    parallel processes, each seeking once to the start of its range.
+    """
+    if workers <= 1:
+        return _sample_range(video_path, frames_dir, 0, num_seconds, resize_w)
+
+    step = math.ceil(num_seconds / workers)
+    ranges = [(start, min(start + step, num_seconds)) for start in range(0, num_seconds, step)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(_sample_range, video_path, frames_dir, start, end, resize_w)
+            for start, end in ranges
+        ]
+        return sum(future.result() for future in futures)
+
+
+def split_video(video_path, out_dir, split_duration=5, resize_w=640, workers=1):
     video_name = os.path.splitext(os.path.basename(video_path))[0]
     base_dir = os.path.join(out_dir, video_name)
 
@@ -19,57 +139,16 @@ def split_video(video_path, out_dir, split_duration=5, resize_w=640):
     # ensure_dir(video_dir)
     ensure_dir(audio_dir)
 
-    duration = float(subprocess.check_output([
-        "ffprobe", "-v", "error", "-show_entries", "format=duration",
-        "-of", "default=noprint_wrappers=1:nokey=1", video_path
-    ]).decode().strip())
+    duration = probe_duration(video_path)
     num_chunks = math.ceil(duration / split_duration)
 
     print(f"Total duration: {duration:.2f}s | Chunks: {num_chunks}")
 
-    cap = cv2.VideoCapture(video_path)
-    fps = cap.get(cv2.CAP_PROP_FPS)
-    frame_count = 0
-
-    for i in range(num_chunks):
-        start = i * split_duration
-
-        # chunk_video = os.path.join(video_dir, f"{video_name}_chunk_{i:04d}.mp4")
-        # subprocess.run([
-        #     "ffmpeg", "-y",
-        #     "-ss", str(start),
-        #     "-t", str(split_duration),
-        #     "-i", video_path,
-        #     "-vf", f"scale={resize_w}:-1",
-        #     "-c:v", "libx264", "-preset", "fast", "-crf", "18",
-        #     "-c:a", "aac",
-        #     chunk_video
-        # ], stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
-
-        chunk_audio = os.path.join(audio_dir, f"{video_name}_chunk_{i:04d}.wav")
-        subprocess.run([
-            "ffmpeg", "-y",
-            "-i", video_path, "-ss", str(start),
-            "-t", str(split_duration),
-            "-vn", "-acodec", "pcm_s16le",
-            chunk_audio
-        ], stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
-
-        for sec in range(split_duration):
-            frame_time = start + sec
-            frame_index = int(frame_time * fps)
-            cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
-            ok, frame = cap.read()
-            if ok:
-                h, w = frame.shape[:2]
-                new_h = int(h * (resize_w / w))
-                resized_frame = cv2.resize(frame, (resize_w, new_h), interpolation=cv2.INTER_LINEAR)
-                frame_count += 1
-                cv2.imwrite(os.path.join(frames_dir, f"{frame_count:08d}.jpg"), resized_frame)
-
-        print(f"✔ Chunk {i+1}/{num_chunks} processed")
+    split_audio(video_path, audio_dir, video_name, split_duration=split_duration, num_chunks=num_chunks)
+
+    frame_count = sample_frames(video_path, frames_dir, num_chunks * split_duration, resize_w=resize_w, workers=workers)
+    print(f"✔ {frame_count} frames written to {frames_dir}")
 
-    cap.release()
     print("\n🎉 Finished!")
 
 